@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#       
+#       auditorium.py
+#       
+#       Counts the bytes the server sends, to everyone, when a user joins
+#       and parts a large channel without saying anything, and when a user
+#       first speaks there, with and without delayed join (+D). Uses the
+#       fake sockets in fake.py, so nothing touches the network.
+#       
+#       Usage: python3 bench/auditorium.py [--members 10000] [--joins 100]
+
+import argparse
+import timeit
+
+import fake
+
+def total(server):
+    return sum([user.socket.sent for user in server.users])
+
+def measure(members, joins, modes):
+    """Bytes and seconds per join, silent part and first message"""
+    server, users = fake.build(members)
+    channel = server.channels[0]
+    channel.modes += modes
+    # One op and a few voiced speakers, like an announcement channel
+    channel.usermodes[users[0]] = 'o'
+    for user in users[1:11]:
+        channel.usermodes[user] = 'v'
+    if 'D' in modes:
+        # Everyone else joined quietly too
+        channel.hidden.update(users[11:])
+    joiners = [fake.add_user(server, "joiner%d" % i) for i in range(joins)]
+    
+    join = lambda user: user.handle_JOIN(("JOIN", channel.name))
+    part = lambda user: user.handle_PART(("PART", channel.name))
+    speak = lambda user: user.handle_PRIVMSG(("PRIVMSG", channel.name, "Hello, world!"))
+    
+    results = []
+    for action in (join, part, join, speak):
+        before = total(server)
+        start = timeit.default_timer()
+        for user in joiners:
+            server.cork()
+            action(user)
+            server.uncork()
+        elapsed = timeit.default_timer() - start
+        results.append(((total(server) - before) / float(joins), elapsed / joins))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure join/part traffic in a large channel")
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--joins", type=int, default=100)
+    args = parser.parse_args()
+    
+    print("%d members, %d joins" % (args.members, args.joins))
+    print("%-8s %22s %22s %22s" % ("modes", "join", "silent part", "first message"))
+    for modes in ("", "D"):
+        results = measure(args.members, args.joins, modes)
+        # The second join is only there to set up the message
+        del results[2]
+        print("%-8s %s" % ("+nt" + modes, " ".join(["%9.0f B %9.1fus" % (size, seconds * 1e6) for size, seconds in results])))
+
+if __name__ == "__main__":
+    main()
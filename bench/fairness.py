@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#       
+#       fairness.py
+#       
+#       Measures delivery latency of interactive traffic (PING/PONG and a
+#       private message) while other clients keep pulling large LIST
+#       replies from the same server. --python and --root run another
+#       interpreter or source tree, to compare against an older version.
+#       
+#       Usage: python3 bench/fairness.py [--samples N] [--bulk N] [--channels N] [--python python2] [--root DIR]
+
+import os
+import sys
+import time
+import select
+import argparse
+import threading
+
+import net
+
+def pull(clients, stop, counts):
+    """Keep every bulk client asking for LIST and reading the reply"""
+    sockets = dict([(client.socket, i) for i, client in enumerate(clients)])
+    tails = [b""] * len(clients)
+    for client in clients:
+        client.send("LIST")
+    while not stop:
+        read, write, error = select.select(list(sockets), [], [], 1.0)
+        for sock in read:
+            i = sockets[sock]
+            data = tails[i] + sock.recv(262144)
+            # Keep a partial line so an end marker split across reads is seen once
+            tails[i] = data[data.rfind(b"\n") + 1:]
+            for n in range(data.count(b" 323 ") - tails[i].count(b" 323 ")):
+                counts[i] += 1
+                clients[i].send("LIST")
+
+def report(name, samples):
+    samples.sort()
+    print("%-8s p50 %8.1fus  p90 %8.1fus  p99 %8.1fus  max %8.1fus" % (
+        name,
+        net.percentile(samples, 0.5) * 1e6,
+        net.percentile(samples, 0.9) * 1e6,
+        net.percentile(samples, 0.99) * 1e6,
+        samples[-1] * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure interactive latency under bulk load")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--bulk", type=int, default=20, help="clients pulling LIST replies")
+    parser.add_argument("--channels", type=int, default=2000, help="channels in each LIST reply")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to run the server with")
+    parser.add_argument("--root", default=net.ROOT, help="source tree to run the server from")
+    args = parser.parse_args()
+    
+    port = 19000 + os.getpid() % 1000
+    server = net.start_server(port, args.python, args.root, history_length=0)
+    try:
+        # Channels only exist while someone is in them
+        owner = net.Client(port, "owner")
+        for i in range(0, args.channels, 100):
+            owner.send("JOIN %s" % ",".join(["#channel%d" % n for n in range(i, min(i + 100, args.channels))]))
+            for n in range(i, min(i + 100, args.channels)):
+                owner.read_until(b" 366 ")
+        
+        bulk = [net.Client(port, "bulk%d" % i, net.address(i)) for i in range(args.bulk)]
+        pinger = net.Client(port, "pinger")
+        
+        stop = []
+        counts = [0] * len(bulk)
+        thread = threading.Thread(target=pull, args=(bulk, stop, counts))
+        thread.start()
+        time.sleep(0.5)
+        
+        pongs = []
+        messages = []
+        listed = sum(counts)
+        start = time.time()
+        for i in range(args.samples):
+            before = time.time()
+            pinger.send("PING :%d" % i)
+            pinger.read_until(b"PONG")
+            pongs.append(time.time() - before)
+            
+            before = time.time()
+            pinger.send("PRIVMSG pinger :%d" % i)
+            pinger.read_until(b" PRIVMSG ")
+            messages.append(time.time() - before)
+        elapsed = time.time() - start
+        stop.append(True)
+        thread.join()
+        
+        print("%s: %d bulk clients, %d channels per LIST" % (args.python, args.bulk, args.channels))
+        report("PONG", pongs)
+        report("PRIVMSG", messages)
+        print("LIST replies/s: %.1f" % ((sum(counts) - listed) / elapsed))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
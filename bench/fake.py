@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+#       fake.py
+#       
+#       In-memory transport and fixture builders for benchmarking
+#       handlers without real sockets or DNS.
+
+import os
+import sys
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+
+# Nothing is loaded from or saved to disk
+config.bans_file = ""
+config.channels_file = ""
+
+# Everything queued is sent when output is uncorked
+config.write_budget = float("inf")
+config.write_time = float("inf")
+
+import ircd
+
+class FakeSocket:
+    """Socket stand-in that accepts everything sent to it, unless broken"""
+    def __init__(self):
+        self.sent = 0
+        self.closed = False
+        self.broken = False
+    
+    def fileno(self):
+        return -1
+    
+    def setblocking(self, flag):
+        pass
+    
+    def setsockopt(self, level, option, value):
+        pass
+    
+    def send(self, data):
+        if self.broken:
+            raise ConnectionResetError("Connection reset by peer")
+        self.sent += len(data)
+        return len(data)
+    
+    def recv(self, size):
+        return b""
+    
+    def close(self):
+        self.closed = True
+
+addresses = itertools.count(1)
+
+def make_server():
+    return ircd.Server()
+
+def add_user(server, nick):
+    """Connect and register a user without touching the network"""
+    n = next(addresses)
+    ip = "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255)
+    server.hostcache[ip] = "host%d.example.com" % n
+    
+    user = ircd.User(server, (FakeSocket(), (ip, 40000)))
+    user.nickname = nick
+    user.username = nick
+    user.realname = "Benchmark user %s" % nick
+    server.index(user)
+    return user
+
+def add_channel(server, name):
+    channel = ircd.Channel(name)
+    channel.modes = "nt"
+    server.channels.append(channel)
+    return channel
+
+def join(user, channel, modes=''):
+    """Put a user in a channel without broadcasting the JOIN"""
+    channel.users.append(user)
+    channel.usermodes[user] = modes
+    user.channels.append(channel)
+
+def build(users, channels=1):
+    """Make a server with users, all of them in every channel"""
+    server = make_server()
+    members = [add_user(server, "user%d" % i) for i in range(users)]
+    for i in range(channels):
+        channel = add_channel(server, "#channel%d" % i)
+        for user in members:
+            join(user, channel)
+    return server, members
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#       handlers.py
+#       
+#       Times individual handlers in memory as the number of users and
+#       channels grows, and fits a scaling exponent to each curve so
+#       quadratic behaviour shows up in review.
+#       
+#       Usage: python bench/handlers.py [--sizes 100,300,1000] [--output results.json] [--compare old.json] [case ...]
+
+import sys
+import json
+import math
+import timeit
+import argparse
+
+import fake
+
+# Each case takes a size and returns (server, run, reset). run is timed
+# with output corked the way the run loop does it, reset (if not None)
+# restores state between runs and is not timed.
+
+def case_connect(n):
+    server, users = fake.build(n)
+    state = []
+    def run():
+        state.append(fake.add_user(server, "new%d" % len(state)))
+    def reset():
+        state[-1].quit("Benchmark")
+    return server, run, reset
+
+def case_join(n):
+    server, users = fake.build(n)
+    joiner = fake.add_user(server, "joiner")
+    def run():
+        joiner.handle_JOIN(("JOIN", "#channel0"))
+    def reset():
+        joiner.handle_PART(("PART", "#channel0"))
+    return server, run, reset
+
+def case_privmsg(n):
+    server, users = fake.build(n)
+    def run():
+        users[0].handle_PRIVMSG(("PRIVMSG", "#channel0", "Hello, world!"))
+    return server, run, None
+
+def case_names(n):
+    server, users = fake.build(n)
+    def run():
+        users[0].handle_NAMES(("NAMES", "#channel0"))
+    return server, run, None
+
+def case_who(n):
+    server, users = fake.build(n)
+    def run():
+        users[0].handle_WHO(("WHO", "#channel0"))
+    return server, run, None
+
+def case_whonick(n):
+    # Ten matches (user120 to user129) however many users are connected
+    server, users = fake.build(n, 0)
+    def run():
+        users[0].handle_WHO(("WHO", "user12?", "%nuh"))
+    return server, run, None
+
+def case_whohost(n):
+    server, users = fake.build(n, 0)
+    def run():
+        users[0].handle_WHO(("WHO", users[-1].hostname))
+    return server, run, None
+
+def case_nick(n):
+    # Everybody shares 10 channels with the user changing nick
+    server, users = fake.build(n, 10)
+    nicks = ["renamed", "user0"]
+    def run():
+        users[0].handle_NICK(("NICK", nicks[0]))
+        nicks.reverse()
+    return server, run, None
+
+def case_quit(n):
+    server, users = fake.build(n, 10)
+    state = [users[0]]
+    def run():
+        state[0].quit("Benchmark")
+    def reset():
+        user = fake.add_user(server, "quitter")
+        for channel in server.channels:
+            fake.join(user, channel)
+        state[0] = user
+    return server, run, reset
+
+def case_timeout(n):
+    # n users ping out at once from 10 channels shared with 100 that stay
+    server, users = fake.build(100, 10)
+    def reset():
+        for i in range(n):
+            user = fake.add_user(server, "timeout%d" % i)
+            user.ping = 0
+            for channel in server.channels:
+                fake.join(user, channel)
+    reset()
+    def run():
+        server.timeouts()
+    return server, run, reset
+
+def case_list(n):
+    # One channel per user
+    server, users = fake.build(0)
+    for i in range(n):
+        fake.join(fake.add_user(server, "user%d" % i), fake.add_channel(server, "#channel%d" % i))
+    def run():
+        server.users[0].handle_LIST(("LIST",))
+    return server, run, None
+
+CASES = [
+    ("connect", case_connect),
+    ("join", case_join),
+    ("privmsg", case_privmsg),
+    ("names", case_names),
+    ("who", case_who),
+    ("whonick", case_whonick),
+    ("whohost", case_whohost),
+    ("nick", case_nick),
+    ("quit", case_quit),
+    ("timeout", case_timeout),
+    ("list", case_list),
+]
+
+def measure(server, run, reset, budget=0.2, limit=1000):
+    """Median time of a single run"""
+    timer = timeit.default_timer
+    times = []
+    start = timer()
+    while times == [] or (timer() - start < budget and len(times) < limit):
+        before = timer()
+        server.cork()
+        run()
+        server.uncork()
+        times.append(timer() - before)
+        if reset is not None:
+            reset()
+    times.sort()
+    return times[len(times) // 2]
+
+def exponent(sizes, times):
+    """Slope of the curve on a log-log scale, ~1 for linear, ~2 for quadratic"""
+    if len(sizes) < 2 or times[0] <= 0 or times[-1] <= 0:
+        return 0.0
+    return math.log(times[-1] / times[0]) / math.log(float(sizes[-1]) / sizes[0])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark handlers in memory")
+    parser.add_argument("cases", nargs="*", help="cases to run (default: all)")
+    parser.add_argument("--sizes", default="100,300,1000", help="comma separated user/channel counts")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = [(name, case) for name, case in CASES if args.cases == [] or name in args.cases]
+    
+    previous = {}
+    if args.compare:
+        f = open(args.compare)
+        try:
+            previous = json.load(f)["results"]
+        finally:
+            f.close()
+    
+    results = {}
+    print("%-10s %s  exponent" % ("case", "".join(["%12d" % size for size in sizes])))
+    for name, case in cases:
+        times = []
+        for size in sizes:
+            server, run, reset = case(size)
+            times.append(measure(server, run, reset))
+        results[name] = {"sizes": sizes, "times": times, "exponent": exponent(sizes, times)}
+        
+        line = "%-10s %s  %8.2f" % (name, "".join(["%10.1fus" % (t * 1e6) for t in times]), results[name]["exponent"])
+        if results[name]["exponent"] > 1.5:
+            line += "  superlinear!"
+        print(line)
+        
+        if name in previous and previous[name]["sizes"] == sizes:
+            ratios = [new / old for new, old in zip(times, previous[name]["times"])]
+            print("%-10s %s" % ("  vs old", "".join(["%11.2fx" % ratio for ratio in ratios])))
+    
+    if args.output:
+        f = open(args.output, "w")
+        try:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#       latency.py
+#       
+#       Measures PING/PONG round-trip latency against a local server.
+#       
+#       Usage: python bench/latency.py [pings] [idle connections]
+
+import os
+import sys
+import time
+
+import net
+
+def main():
+    pings = 2000
+    idle = 300
+    if len(sys.argv) > 1:
+        pings = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        idle = int(sys.argv[2])
+    port = 16000 + os.getpid() % 1000
+    
+    server = net.start_server(port)
+    try:
+        clients = []
+        for i in range(idle):
+            clients.append(net.Client(port, "idle%d" % i, net.address(i)))
+        
+        client = net.Client(port, "pinger")
+        samples = []
+        for i in range(pings):
+            start = time.time()
+            client.send("PING :%d" % i)
+            client.read_until(b"PONG")
+            samples.append(time.time() - start)
+        samples.sort()
+        
+        print("%d pings, %d idle connections" % (pings, idle))
+        print("mean:   %7.1fus" % (sum(samples) / len(samples) * 1e6))
+        print("median: %7.1fus" % (net.percentile(samples, 0.5) * 1e6))
+        print("p90:    %7.1fus" % (net.percentile(samples, 0.9) * 1e6))
+        print("p99:    %7.1fus" % (net.percentile(samples, 0.99) * 1e6))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+#       net.py
+#       
+#       Server process and client helpers shared by the benchmarks that
+#       talk to a real server over loopback.
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Nothing is loaded from or saved to disk, and flood control is off so
+# the benchmarks are not throttled
+SERVER = """
+import sys
+sys.path.insert(0, %r)
+import config
+config.bind_host = "127.0.0.1"
+config.bind_port = %d
+config.bans_file = ""
+config.channels_file = ""
+config.capture_file = ""
+config.flood_burst = 1e9
+config.flood_rate = 1e9
+%s
+import ircd
+server = ircd.Server()
+try:
+    server.run()
+except KeyboardInterrupt:
+    pass
+"""
+
+def start_server(port, python=sys.executable, root=ROOT, **settings):
+    """Run a server on port, with extra config.py settings"""
+    lines = ["config.%s = %r" % (name, value) for name, value in sorted(settings.items())]
+    process = subprocess.Popen([python, "-c", SERVER % (os.path.abspath(root), port, "\n".join(lines))])
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+def address(i):
+    """Loopback address for the ith client, as the server allows 3 connections per IP"""
+    return "127.0.%d.%d" % (1 + i // 250, 1 + i % 250)
+
+class Client:
+    """A registered client connected from source"""
+    def __init__(self, port, nick, source="127.0.0.1"):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((source, 0))
+        self.socket.connect(("127.0.0.1", port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.recvbuffer = b""
+        self.send("NICK %s\r\nUSER %s 0 * :%s" % (nick, nick, nick))
+        self.read_until(b" 376 ")
+    
+    def send(self, data):
+        self.socket.sendall((data + "\r\n").encode())
+    
+    def read_until(self, marker):
+        """Read up to and including the line containing marker"""
+        while marker not in self.recvbuffer:
+            data = self.socket.recv(262144)
+            if not data:
+                raise RuntimeError("connection closed")
+            self.recvbuffer += data
+        end = self.recvbuffer.find(b"\n", self.recvbuffer.index(marker))
+        self.recvbuffer = self.recvbuffer[end + 1:]
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
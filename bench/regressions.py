@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#       
+#       regressions.py
+#       
+#       Behaviour checks against the in-memory server from fake.py: ban
+#       matching, WHO lookups, CHATHISTORY selection, the channel store,
+#       and edge cases of the output path, parsing and flood control.
+#       Prints each check and exits non-zero if any fails.
+#       
+#       Usage: python3 bench/regressions.py [check ...]
+
+import os
+import sys
+import random
+import shutil
+import ipaddress
+import tempfile
+import traceback
+
+import fake
+
+def record(user):
+    """List that collects everything sent to user from now on"""
+    sent = []
+    user.socket.send = lambda data: sent.append(bytes(data)) or len(data)
+    return sent
+
+def check_quit_write_error():
+    # A member whose socket fails while it is sent a mass QUIT is quit too,
+    # and must not be left in the channel without its usermodes
+    server, users = fake.build(3)
+    users[1].socket.broken = True
+    users[0].ping = 0
+    server.timeouts()
+    channel = server.channels[0]
+    assert channel.users == [users[2]], channel.users
+    assert server.users == [users[2]], server.users
+    users[2].handle_NAMES(("NAMES", channel.name))
+
+def check_store_carriage_return():
+    # A topic with a bare CR used to split its saved line, and the restart
+    # that read it back crashed
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "channels.db")
+        server, users = fake.build(2)
+        channel = server.channels[0]
+        channel.topic = "before\rafter"
+        store = fake.ircd.ChannelStore(path)
+        store.mark(channel)
+        store.snapshot(wait=True)
+        store.mark(channel)
+        channel.topic = "journal\rtopic"
+        store.flush()
+        # And a record that was damaged some other way
+        f = open(store.journal(store.generation), 'a')
+        f.write("SET #broken\n")
+        f.close()
+        
+        # The constructor loads the snapshot and journals
+        store = fake.ircd.ChannelStore(path)
+        assert store.changes == 2, store.changes
+        assert list(store.lines) == [channel.name.lower()], store.lines
+        restored = fake.ircd.Channel(channel.name)
+        assert store.restore(restored)
+        assert restored.topic == "journaltopic", restored.topic
+    finally:
+        shutil.rmtree(directory)
+
+def check_stats_empty():
+    # "STATS :" has an empty parameter rather than none
+    server, users = fake.build(1)
+    sent = record(users[0])
+    users[0].handle_STATS(("STATS", ""))
+    assert b" 461 " in b"".join(sent), sent
+
+def check_delayed_join_ops():
+    # Ops are not sent the JOIN, PART or QUIT of a hidden member, so
+    # NAMES must not list it to them either, only NAMES -d
+    server, users = fake.build(2)
+    channel = server.channels[0]
+    op, member = users
+    channel.usermodes[op] = 'o'
+    channel.modes += 'D'
+    member.handle_PART(("PART", channel.name))
+    member.handle_JOIN(("JOIN", channel.name))
+    assert channel.visible(op) == [op], channel.visible(op)
+    assert channel.visible(member) == [op, member], channel.visible(member)
+    
+    sent = record(op)
+    op.handle_NAMES(("NAMES", channel.name))
+    op.handle_NAMES(("NAMES", "-d", channel.name))
+    replies = b"".join(sent)
+    assert b" 353 %s @ %s :@%s\r\n" % (op.nickname.encode(), channel.name.encode(), op.nickname.encode()) in replies, replies
+    assert b" 355 %s @ %s :%s\r\n" % (op.nickname.encode(), channel.name.encode(), member.nickname.encode()) in replies, replies
+    
+    # Once it speaks it is an ordinary member for everyone
+    member.handle_PRIVMSG(("PRIVMSG", channel.name, "hello"))
+    assert channel.visible(op) == [op, member], channel.visible(op)
+
+def check_free_commands():
+    # Every command spends flood budget, or it can be sent without limit
+    server, users = fake.build(1)
+    user = users[0]
+    for command in sorted(user.commands):
+        assert user.commands[command][1] > 0, command
+    user.socket.send = lambda data: len(data)
+    user.recvbuffer += b"CAP LS\r\n" * 1000
+    user.handle_recv()
+    assert user.throttled, user.budget
+
+def check_history_bytes():
+    # The history budget is in bytes, not characters
+    history = fake.ircd.History(10, 10)
+    history.add(1, 0, "\u00e9" * 4)
+    history.add(2, 0, "\u00e9" * 4)
+    assert len(history) == 1 and history.bytes == 8, (len(history), history.bytes)
+
+def check_formatting_codes():
+    # Only spaces and CRs are stripped from a line, Python 3's str.strip()
+    # also removed the underline and italics codes from the end
+    server, users = fake.build(2)
+    sent = record(users[1])
+    users[0].recvbuffer += b"PRIVMSG #channel0 :\x1funderlined\x1f \x1ditalic\x1d\r\n"
+    users[0].handle_recv()
+    assert b":\x1funderlined\x1f \x1ditalic\x1d\r\n" in b"".join(sent), sent
+
+def check_bans_partial_record():
+    # A crash during an append can leave half a record at the end of
+    # bans.db, which must not stop the server from starting
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "bans.db")
+        f = open(path, 'w')
+        f.write("ADD K *@bad.example 1 0 oper :spam\n")
+        f.write("ADD K broken\n")
+        f.write("DEL K\n")
+        f.write("ADD K *@ho")
+        f.close()
+        bans = fake.ircd.BanList(path)
+        assert list(bans.bans) == [('K', '*@bad.example')], bans.bans
+        assert open(path).read() == "ADD K *@bad.example 1 0 oper :spam\n", open(path).read()
+    finally:
+        shutil.rmtree(directory)
+
+def check_history_zero_limit():
+    # A limit of 0 used to select the whole buffer through [-0:]
+    history = fake.ircd.History(100, 1 << 20)
+    for i in range(50):
+        history.add(i, i, "line %d" % i)
+    assert history.select("LATEST", ['*'], 0) == []
+    assert history.select("BEFORE", [("msgid", 40)], 0) == []
+    
+    server, users = fake.build(1)
+    user = users[0]
+    channel = server.channels[0]
+    channel.history = history
+    sent = record(user)
+    user.handle_CHATHISTORY(("CHATHISTORY", "LATEST", channel.name, "*", "0"))
+    assert b"".join(sent).endswith(b" FAIL CHATHISTORY INVALID_PARAMS LATEST :Invalid limit\r\n"), sent
+
+def check_message_tags():
+    # Live channel messages carry the msgid and time that CHATHISTORY
+    # uses, for members that asked for them, and tagged input is accepted
+    server, users = fake.build(3)
+    sender, tagged, plain = users
+    tagged.handle_CAP(("CAP", "REQ", "server-time message-tags"))
+    tagged_sent = record(tagged)
+    plain_sent = record(plain)
+    sender.recvbuffer += b"@+draft/reply=1 PRIVMSG #channel0 :hello\r\n"
+    sender.handle_recv()
+    
+    line = b"".join(tagged_sent)
+    assert line.startswith(b"@time=") and b";msgid=%d :" % server.msgid in line, line
+    assert line.endswith(b" PRIVMSG #channel0 :hello\r\n"), line
+    assert b"".join(plain_sent) == b":%s PRIVMSG #channel0 :hello\r\n" % sender.fullname().encode(), plain_sent
+    
+    history = server.channels[0].history
+    assert history.entries[-1][0] == server.msgid, history.entries
+
+def check_join_targets():
+    # Every channel in a comma separated JOIN or PART is charged
+    server, users = fake.build(1, channels=0)
+    user = users[0]
+    user.socket.send = lambda data: len(data)
+    names = ",".join(["#c%d" % i for i in range(50)])
+    user.recvbuffer += b"JOIN " + names.encode() + b"\r\n"
+    user.handle_recv()
+    assert len(user.channels) == 50, len(user.channels)
+    assert user.budget < 0, user.budget
+    
+    user.budget = fake.config.flood_burst
+    user.recvbuffer += b"PART " + names.encode() + b" :bye\r\n"
+    user.handle_recv()
+    assert user.channels == [], user.channels
+    assert user.budget < 0, user.budget
+
+def check_who_ip():
+    # Only opers can search by IP or see the real IP in WHOX replies
+    server, users = fake.build(2)
+    user, other = users
+    sent = record(user)
+    user.handle_WHO(("WHO", other.ip, "%nhi"))
+    user.handle_WHO(("WHO", other.nickname, "%nhi"))
+    replies = b"".join(sent)
+    # WHOX fields come in a fixed order, the IP before the host
+    assert replies.count(b" 354 ") == 1, replies
+    assert b" 354 %s 255.255.255.255 %s %s\r\n" % (user.nickname.encode(), other.hostname.encode(), other.nickname.encode()) in replies, replies
+    
+    del sent[:]
+    user.oper = True
+    user.handle_WHO(("WHO", other.ip, "%nhi"))
+    replies = b"".join(sent)
+    assert b" 354 %s %s %s %s\r\n" % (user.nickname.encode(), other.ip.encode(), other.hostname.encode(), other.nickname.encode()) in replies, replies
+
+def check_disconnect_corked():
+    # Replies still held by the cork go out ahead of the ERROR line
+    server, users = fake.build(1)
+    user = users[0]
+    sent = record(user)
+    server.cork()
+    user.recvbuffer += b"PING :before\r\nQUIT :bye\r\n"
+    user.handle_recv()
+    server.uncork()
+    replies = b"".join(sent)
+    assert b" PONG " in replies and replies.index(b" PONG ") < replies.index(b"ERROR :"), replies
+
+def check_prefix_trie():
+    # Z-Lines found through the trie agree with checking every network
+    bans = fake.ircd.BanList("")
+    masks = ["10.0.0.0/8", "10.1.0.0/16", "10.1.2.3", "192.168.0.0/23", "0.0.0.0/1", "2001:db8::/32", "2001:db8:1::1"]
+    for mask in masks:
+        bans.add(fake.ircd.Ban('Z', mask, "test", "oper"))
+    bans.remove('Z', "0.0.0.0/1")
+    networks = [ipaddress.ip_network(mask) for mask in masks if mask != "0.0.0.0/1"]
+    
+    rng = random.Random(1)
+    addresses = ["10.1.2.3", "10.1.2.4", "10.2.0.1", "11.0.0.1", "192.168.1.255", "192.168.2.0", "2001:db8:1::1", "2001:db9::1"]
+    addresses += ["%d.%d.%d.%d" % tuple(rng.choice([10, 192, 168, 1, 2, 3, 0, 255]) for i in range(4)) for n in range(500)]
+    for address in addresses:
+        ip = ipaddress.ip_address(address)
+        expected = set([str(network) for network in networks if network.version == ip.version and ip in network])
+        family, packed, length = fake.ircd.parse_cidr(address)
+        found = set([str(ipaddress.ip_network(ban.mask)) for ban in bans.zlines[family].search(packed)])
+        assert found == expected, (address, found, expected)
+        assert (bans.match_ip(address) is not None) == (expected != set()), address
+
+def check_who_lookup():
+    # WHO masks found through the nick and host indexes agree with
+    # matching every user
+    server, users = fake.build(300, channels=0)
+    for user in users[::7]:
+        server.unindex(user)
+        user.hostname = "gateway.example.net"
+        server.index(user)
+    masks = ["*", "user1*", "*7", "user?", "*er2*", "u*r*9", "host1?.example.com", "*.example.net", "gateway.*", "nobody*", "USER25"]
+    for mask in masks:
+        regex = fake.ircd.compile_mask(mask)
+        expected = set([user for user in users if regex.match(user.nickname) or regex.match(user.hostname)])
+        found = server.lookup(mask, "nh")
+        assert set(found) == expected and len(found) == len(expected), mask
+
+def check_history_select():
+    # CHATHISTORY selectors exclude the messages they name
+    history = fake.ircd.History(100, 1 << 20)
+    for i in range(1, 21):
+        history.add(i, float(i), "line %d" % i)
+    def select(subcommand, selectors, limit):
+        return [entry[0] for entry in history.select(subcommand, selectors, limit)]
+    msgid = lambda n: ("msgid", n)
+    assert select("LATEST", ['*'], 5) == [16, 17, 18, 19, 20]
+    assert select("LATEST", [msgid(17)], 5) == [18, 19, 20]
+    assert select("BEFORE", [msgid(10)], 3) == [7, 8, 9]
+    assert select("BEFORE", [("timestamp", 10.0)], 3) == [7, 8, 9]
+    assert select("AFTER", [msgid(10)], 3) == [11, 12, 13]
+    assert select("AFTER", [msgid(19)], 3) == [20]
+    assert select("AROUND", [msgid(10)], 4) == [8, 9, 10, 11]
+    assert select("BETWEEN", [msgid(5), msgid(10)], 10) == [6, 7, 8, 9]
+    assert select("BETWEEN", [msgid(10), msgid(5)], 2) == [8, 9]
+    assert select("BETWEEN", [msgid(5), msgid(10)], 2) == [6, 7]
+
+def check_store_round_trip():
+    # Channel state survives a snapshot, later journal records and a reload
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "channels.db")
+        server, users = fake.build(1, channels=3)
+        first, second, third = server.channels
+        first.modes = "imnt"
+        first.topic = "A topic: with colons  and  spaces"
+        first.topic_author = "user0!user0@host.example.com"
+        first.topic_time = 1234567890
+        first.lists['b'].append(("bad!*@*", "user0!user0@host.example.com", 1000))
+        first.lists['e'].append(("*!*@good.example", "user0", 1001))
+        first.lists['I'].append(("friend!*@*", "user0", 1002))
+        store = fake.ircd.ChannelStore(path)
+        for channel in server.channels:
+            store.mark(channel)
+        store.snapshot(wait=True)
+        
+        # Changed, dropped and untouched after the snapshot
+        second.modes = "mt"
+        store.mark(second)
+        store.drop(third)
+        store.flush()
+        
+        store = fake.ircd.ChannelStore(path)
+        assert sorted(store.lines) == [first.name, second.name], store.lines
+        for channel in (first, second):
+            restored = fake.ircd.Channel(channel.name.upper())
+            assert store.restore(restored)
+            for field in ("creation", "modes", "topic", "topic_author", "topic_time", "lists"):
+                assert getattr(restored, field) == getattr(channel, field), (field, getattr(restored, field))
+        assert not store.restore(fake.ircd.Channel(third.name))
+    finally:
+        shutil.rmtree(directory)
+
+checks = [
+    ("quit_write_error", check_quit_write_error),
+    ("store_carriage_return", check_store_carriage_return),
+    ("stats_empty", check_stats_empty),
+    ("delayed_join_ops", check_delayed_join_ops),
+    ("free_commands", check_free_commands),
+    ("history_bytes", check_history_bytes),
+    ("formatting_codes", check_formatting_codes),
+    ("bans_partial_record", check_bans_partial_record),
+    ("history_zero_limit", check_history_zero_limit),
+    ("message_tags", check_message_tags),
+    ("join_targets", check_join_targets),
+    ("who_ip", check_who_ip),
+    ("disconnect_corked", check_disconnect_corked),
+    ("prefix_trie", check_prefix_trie),
+    ("who_lookup", check_who_lookup),
+    ("history_select", check_history_select),
+    ("store_round_trip", check_store_round_trip),
+]
+
+def main():
+    names = sys.argv[1:]
+    failed = 0
+    for name, check in checks:
+        if names != [] and name not in names:
+            continue
+        try:
+            check()
+            print("%-24s ok" % name)
+        except Exception:
+            failed += 1
+            print("%-24s FAIL" % name)
+            traceback.print_exc()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
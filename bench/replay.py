@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#       
+#       replay.py
+#       
+#       Replays traffic recorded with config.capture_file against a server
+#       started on a local port, either at the recorded pacing or as fast
+#       as possible, and reports the latency of each command and the total
+#       wall time. Every line is followed by a PING, and the time to its
+#       PONG is the latency of that line. --python and --root run another
+#       interpreter or source tree, to compare against an older version.
+#       
+#       Usage: python3 bench/replay.py [--fast] [--speed N] [--python python2] [--root DIR] capture [capture ...]
+
+import os
+import sys
+import time
+import select
+import socket
+import argparse
+import threading
+import collections
+
+import net
+
+def capture_files(paths):
+    """Expand each capture path into its rotated files, oldest first"""
+    files = []
+    for path in paths:
+        rotated = []
+        n = 1
+        while os.path.exists("%s.%d" % (path, n)):
+            rotated.insert(0, "%s.%d" % (path, n))
+            n += 1
+        files.extend(rotated)
+        files.append(path)
+    return files
+
+def read_events(files):
+    """(time, connection, kind, data) for every record in the captures"""
+    events = []
+    for name in files:
+        f = open(name, encoding="utf-8", errors="surrogateescape", newline="\n")
+        try:
+            for line in f:
+                # Ignore a partially written last record
+                if not line.endswith("\n"):
+                    break
+                fields = line[:-1].split(" ", 3)
+                if len(fields) == 3:
+                    fields.append(None)
+                events.append((float(fields[0]), int(fields[1]), fields[2], fields[3]))
+        finally:
+            f.close()
+    return events
+
+class Connection:
+    def __init__(self, port, source):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((source, 0))
+        self.socket.connect(("127.0.0.1", port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.recvbuffer = b""
+        # (command, time sent) for each line still waiting for its PONG
+        self.waiting = collections.deque()
+        self.closed = False
+    
+    def send(self, command, data):
+        self.waiting.append((command, time.time()))
+        try:
+            self.socket.sendall(data)
+        except socket.error:
+            self.closed = True
+
+class Replay:
+    def __init__(self, port):
+        self.port = port
+        self.connections = {}
+        self.sources = {}
+        self.latencies = collections.defaultdict(list)
+        self.lost = 0
+        self.lock = threading.Lock()
+        self.done = False
+        # Written to when connections change, so receive selects on them
+        self.wakeup = socket.socketpair()
+    
+    def source(self, ip):
+        """Loopback address standing in for an IP from the capture"""
+        if ip not in self.sources:
+            self.sources[ip] = net.address(len(self.sources))
+        return self.sources[ip]
+    
+    def event(self, number, kind, data):
+        if kind == '+' or (kind == '>' and number not in self.connections):
+            # Connections from before a rotation have no '+' record
+            self.close(number)
+            connection = Connection(self.port, self.source(data if kind == '+' else None))
+            with self.lock:
+                self.connections[number] = connection
+            self.wakeup[1].send(b"x")
+        if kind == '>':
+            connection = self.connections[number]
+            if connection.closed:
+                return
+            command = data.split(" ", 1)[0].upper() or "(empty)"
+            line = data.encode("utf-8", "surrogateescape") + b"\r\n"
+            if command == "QUIT":
+                # Nothing is answered after QUIT, its latency is until the close
+                connection.send(command, line)
+            else:
+                connection.send(command, line + b"PING :replay\r\n")
+        elif kind == '-':
+            self.close(number)
+    
+    def close(self, number):
+        with self.lock:
+            connection = self.connections.pop(number, None)
+        if connection is not None and not connection.closed:
+            connection.closed = True
+            try:
+                connection.socket.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            # Keep reading it until the server closes it too
+            with self.lock:
+                self.connections[(number, id(connection))] = connection
+            self.wakeup[1].send(b"x")
+    
+    def receive(self):
+        """Match PONGs to the lines they follow until every connection is done"""
+        while True:
+            with self.lock:
+                connections = list(self.connections.items())
+            if connections == [] and self.done:
+                return
+            sockets = dict([(connection.socket, (key, connection)) for key, connection in connections])
+            read, write, error = select.select([self.wakeup[0]] + list(sockets), [], [], 0.1)
+            now = time.time()
+            for sock in read:
+                if sock == self.wakeup[0]:
+                    sock.recv(4096)
+                    continue
+                key, connection = sockets[sock]
+                try:
+                    data = sock.recv(262144)
+                except socket.error:
+                    data = b""
+                if not data:
+                    self.finish(key, connection, now)
+                    continue
+                lines = (connection.recvbuffer + data).split(b"\n")
+                connection.recvbuffer = lines.pop()
+                for line in lines:
+                    # The server's own PINGs are answered by PONGs in the capture
+                    if b" PONG " in line and line.endswith(b":replay\r") and connection.waiting:
+                        command, sent = connection.waiting.popleft()
+                        self.latencies[command].append(now - sent)
+    
+    def finish(self, key, connection, now):
+        """The server closed a connection"""
+        connection.closed = True
+        connection.socket.close()
+        while connection.waiting:
+            command, sent = connection.waiting.popleft()
+            if command == "QUIT":
+                self.latencies[command].append(now - sent)
+            else:
+                self.lost += 1
+        with self.lock:
+            self.connections.pop(key, None)
+    
+    def wait(self, timeout):
+        """Close what the capture left open once its lines are answered"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                connections = list(self.connections.values())
+            if not [connection for connection in connections if connection.waiting]:
+                break
+            time.sleep(0.01)
+        with self.lock:
+            numbers = [key for key in self.connections if not isinstance(key, tuple)]
+        for number in numbers:
+            self.close(number)
+        self.done = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured client traffic")
+    parser.add_argument("captures", nargs="+", help="capture files, rotated files are found automatically")
+    parser.add_argument("--fast", action="store_true", help="send as fast as possible instead of at the recorded pacing")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed up the recorded pacing by this factor")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for the last replies")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to run the server with")
+    parser.add_argument("--root", default=net.ROOT, help="source tree to run the server from")
+    args = parser.parse_args()
+    
+    events = read_events(capture_files(args.captures))
+    if events == []:
+        print("Nothing to replay")
+        return
+    
+    port = 20000 + os.getpid() % 1000
+    server = net.start_server(port, args.python, args.root)
+    try:
+        replay = Replay(port)
+        thread = threading.Thread(target=replay.receive)
+        thread.start()
+        
+        first = events[0][0]
+        start = time.time()
+        try:
+            for when, number, kind, data in events:
+                if not args.fast:
+                    delay = start + (when - first) / args.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                replay.event(number, kind, data)
+            replay.wait(args.timeout)
+        finally:
+            replay.done = True
+            thread.join()
+        elapsed = time.time() - start
+        
+        lines = len([event for event in events if event[2] == '>'])
+        print("%s: %d lines on %d connections in %.2fs (recorded over %.2fs)" % (
+            args.python, lines, len([event for event in events if event[2] == '+']), elapsed, events[-1][0] - first))
+        print("%-12s %8s %10s %10s %10s %10s" % ("command", "count", "p50", "p90", "p99", "max"))
+        for command in sorted(replay.latencies):
+            samples = sorted(replay.latencies[command])
+            print("%-12s %8d %8.1fus %8.1fus %8.1fus %8.1fus" % (
+                command, len(samples),
+                net.percentile(samples, 0.5) * 1e6,
+                net.percentile(samples, 0.9) * 1e6,
+                net.percentile(samples, 0.99) * 1e6,
+                samples[-1] * 1e6))
+        if replay.lost:
+            print("%d lines were not answered before their connection closed" % replay.lost)
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#       startup.py
+#       
+#       Times loading saved channel state at startup.
+#       
+#       Usage: python bench/startup.py [channels] [journal records]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ircd
+
+def populate(path, channels, records):
+    store = ircd.ChannelStore(path)
+    for i in range(channels):
+        channel = ircd.Channel("#channel%d" % i)
+        channel.modes = "nt"
+        channel.topic = "Topic for channel %d, with some text to make it a realistic length" % i
+        channel.topic_author = "services!services@services.example.com"
+        channel.topic_time = int(time.time())
+        for n in range(i % 4):
+            channel.set_mask('b', "*!*@banned%d.example.com" % n, "services!services@services.example.com", True)
+        store.mark(channel)
+    store.flush()
+    store.snapshot(wait=True)
+    
+    # Changes made since the last snapshot are replayed from the journal
+    for i in range(records):
+        channel = ircd.Channel("#channel%d" % (i % channels))
+        store.restore(channel)
+        channel.topic = "Updated topic %d" % i
+        store.mark(channel)
+        if i % 100 == 99:
+            store.flush()
+    store.flush()
+
+def main():
+    channels = 50000
+    records = 10000
+    if len(sys.argv) > 1:
+        channels = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        records = int(sys.argv[2])
+    
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "channels.db")
+        populate(path, channels, records)
+        
+        start = time.time()
+        store = ircd.ChannelStore(path)
+        loaded = time.time() - start
+        
+        # Channels are normally restored one at a time as they are created
+        start = time.time()
+        for name in store.lines:
+            store.restore(ircd.Channel(name))
+        restored = time.time() - start
+        
+        size = sum([os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)])
+        print("%d channels, %d journal records, %d bytes on disk" % (len(store.lines), records, size))
+        print("load:    %.3fs" % loaded)
+        print("restore: %.3fs (all channels)" % restored)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
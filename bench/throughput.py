@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#       throughput.py
+#       
+#       Measures channel message throughput of a server started on a
+#       local port. --python and --root run another interpreter or source
+#       tree, to compare against an older version.
+#       
+#       Usage: python3 bench/throughput.py [--messages N] [--receivers N] [--python python2] [--root DIR]
+
+import os
+import sys
+import time
+import select
+import argparse
+import threading
+
+import net
+
+def join(client):
+    client.send("JOIN #bench")
+    client.read_until(b" 366 ")
+    return client
+
+def receive(receivers, expected, counts):
+    """Count PRIVMSGs arriving at the receivers until all have arrived"""
+    sockets = dict([(client.socket, i) for i, client in enumerate(receivers)])
+    tails = [b""] * len(receivers)
+    while sum(counts) < expected:
+        read, write, error = select.select(list(sockets), [], [], 10.0)
+        if read == []:
+            raise RuntimeError("timed out with %d of %d messages" % (sum(counts), expected))
+        for sock in read:
+            i = sockets[sock]
+            data = tails[i] + sock.recv(262144)
+            counts[i] += data.count(b" PRIVMSG ")
+            # Keep a partial line so a PRIVMSG split across reads is counted once
+            tails[i] = data[data.rfind(b"\n") + 1:]
+            counts[i] -= tails[i].count(b" PRIVMSG ")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure channel message throughput")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--receivers", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=10, help="messages sent between PINGs")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to run the server with")
+    parser.add_argument("--root", default=net.ROOT, help="source tree to run the server from")
+    args = parser.parse_args()
+    
+    port = 18000 + os.getpid() % 1000
+    server = net.start_server(port, args.python, args.root, history_length=0)
+    try:
+        receivers = [join(net.Client(port, "recv%d" % i, net.address(i))) for i in range(args.receivers)]
+        sender = join(net.Client(port, "sender"))
+        
+        counts = [0] * len(receivers)
+        thread = threading.Thread(target=receive, args=(receivers, args.messages * len(receivers), counts))
+        thread.start()
+        
+        start = time.time()
+        for i in range(0, args.messages, args.batch):
+            sender.send("\r\n".join(["PRIVMSG #bench :message number %d with some padding text" % n for n in range(i, min(i + args.batch, args.messages))]))
+            # Wait for the server to catch up, so its receive buffer stays small
+            sender.send("PING :%d" % i)
+            sender.read_until(b"PONG")
+        thread.join()
+        elapsed = time.time() - start
+        
+        delivered = sum(counts)
+        print("%s: %d messages to %d receivers in %.2fs" % (args.python, args.messages, len(receivers), elapsed))
+        print("messages/s:   %10.0f" % (args.messages / elapsed))
+        print("deliveries/s: %10.0f" % (delivered / elapsed))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -19,3 +19,19 @@ motd = """                                         __               __
                              
                      WARNING: This server is very unstable
 """
+opers = {}
+bans_file = "bans.db"
+history_length = 100
+history_size = 16384
+history_batch = 100
+channels_file = "channels.db"
+snapshot_interval = 300
+flood_burst = 20
+flood_rate = 2.0
+recvq_limit = 8192
+write_quantum = 4096
+write_budget = 262144
+write_time = 0.01
+capture_file = ""
+capture_size = 67108864
+capture_keep = 4
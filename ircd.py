@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 #       ircd.py
@@ -22,14 +22,60 @@
 
 import socket
 import time
+import os
+import re
+import heapq
+import bisect
+import binascii
+import calendar
+import collections
+import threading
 
 from select import select
 
 import config
 
 class User:
-    def __init__(self, server, (sock, address)):
+    # Command -> (handler, flood penalty, needs registration)
+    commands = {
+        "PING": ("handle_PING", 1, False),
+        "PONG": ("handle_PONG", 1, False),
+        "NICK": ("handle_NICK", 2, False),
+        "USER": ("handle_USER", 1, False),
+        "CAP": ("handle_CAP", 1, False),
+        "MOTD": ("handle_MOTD", 2, True),
+        "PRIVMSG": ("handle_PRIVMSG", 1, True),
+        "NOTICE": ("handle_NOTICE", 1, True),
+        "JOIN": ("handle_JOIN", 2, True),
+        "PART": ("handle_PART", 1, True),
+        "NAMES": ("handle_NAMES", 2, True),
+        "TOPIC": ("handle_TOPIC", 1, True),
+        "ISON": ("handle_ISON", 1, True),
+        "AWAY": ("handle_AWAY", 1, True),
+        "MODE": ("handle_MODE", 1, True),
+        "WHOIS": ("handle_WHOIS", 2, True),
+        "WHO": ("handle_WHO", 3, True),
+        "KICK": ("handle_KICK", 1, True),
+        "VERSION": ("handle_VERSION", 1, True),
+        "LIST": ("handle_LIST", 10, True),
+        "INVITE": ("handle_INVITE", 2, True),
+        "USERHOST": ("handle_USERHOST", 1, True),
+        "QUIT": ("handle_QUIT", 1, True),
+        "OPER": ("handle_OPER", 3, True),
+        "KLINE": ("handle_KLINE", 1, True),
+        "UNKLINE": ("handle_UNKLINE", 1, True),
+        "ZLINE": ("handle_ZLINE", 1, True),
+        "UNZLINE": ("handle_UNZLINE", 1, True),
+        "STATS": ("handle_STATS", 3, True),
+        "CHATHISTORY": ("handle_CHATHISTORY", 3, True),
+    }
+    
+    def __init__(self, server, connection):
+        sock, address = connection
         self.socket = sock
+        self.socket.setblocking(0)
+        # Replies are already batched per loop iteration, don't delay them further
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.addr = address
         self.ip = self.addr[0]
         self.port = self.addr[1]
@@ -37,9 +83,11 @@ class User:
         self.server = server
         
         self.server.users.append(self)
+        self.server.capture.connect(self)
         
-        self.recvbuffer = ""
-        self.sendbuffer = ""
+        # Raw bytes from and to the socket
+        self.recvbuffer = bytearray()
+        self.sendbuffer = bytearray()
         
         self.ping = time.time()
         self.signon = int(time.time())
@@ -47,8 +95,41 @@ class User:
         self.nickname = "*"
         self.username = "unknown"
         self.realname = "Unknown"
+        self.hostname = self.ip
+        
+        self.away = False
+        
+        self.channels = []
+        
+        self.oper = False
         
-        if self.server.hostcache.has_key(self.ip):
+        self.invites = []
+        
+        # IRCv3 capabilities, registration waits for CAP END once negotiation starts
+        self.caps = []
+        self.capneg = False
+        # (server-time, message-tags) enabled, the tags on channel messages
+        self.tags = (False, False)
+        
+        # Lines waiting for room in the sendbuffer (see fill)
+        self.pending = collections.deque()
+        
+        # Write scheduling (see Server.send_backlogs)
+        self.urgent = False
+        self.turn = 0
+        
+        # Flood control (see handle_recv)
+        self.budget = config.flood_burst
+        self.budget_time = time.time()
+        self.throttled = False
+        
+        # Z-Lines are checked before the DNS lookup
+        zline = self.server.bans.match_ip(self.ip)
+        if zline:
+            self.quit("Z-Lined: %s" % zline.reason)
+            return
+        
+        if self.ip in self.server.hostcache:
             self.hostname = self.server.hostcache[self.ip]
         else:
             try:
@@ -57,16 +138,10 @@ class User:
                 self.hostname = self.ip
             self.server.hostcache[self.ip] = self.hostname
         
-        self.away = False
-        
-        self.channels = []
-        
         # Max connections per ip
-        connections = filter(lambda u: u.ip == self.ip, self.server.users)
+        connections = [u for u in self.server.users if u.ip == self.ip]
         if len(connections) > 3:
             self.quit("Too many connections from %s" % self.ip)
-
-        self.oper = False
     
     def __repr__(self):
         return "<User '%s'>" % self.fullname()
@@ -78,6 +153,9 @@ class User:
         return "%s!%s@%s" % (self.nickname, self.username, self.hostname)
     
     def parse_command(self, data):
+        # Tags sent by clients are accepted, but not relayed
+        if data.startswith('@'):
+            data = data.partition(' ')[2].lstrip(' ')
         xwords = data.split(' ')
         words = []
         for i in range(len(xwords)):
@@ -89,7 +167,52 @@ class User:
         return words
     
     def _send(self, data):
-        self.sendbuffer += data + "\r\n"
+        self.write(encode(data + "\r\n"))
+    
+    def write(self, data):
+        """Queue raw bytes, which may be shared with other recipients"""
+        empty = not self.sendbuffer
+        self.sendbuffer += data
+        if empty:
+            self.server.queue_write(self)
+    
+    def send_paced(self, lines):
+        """Queue lines to be sent as the sendbuffer drains"""
+        empty = not self.sendbuffer
+        self.pending.extend(lines)
+        self.fill()
+        if empty and self.sendbuffer:
+            self.server.queue_write(self)
+    
+    def fill(self):
+        while self.pending and len(self.sendbuffer) < 4096:
+            self.sendbuffer += encode(self.pending.popleft() + "\r\n")
+    
+    def flush(self, limit=None):
+        """Write the sendbuffer until the socket is full or limit bytes are sent
+        
+        Returns the number of bytes written.
+        """
+        total = 0
+        while self.sendbuffer and (limit is None or total < limit):
+            if limit is None:
+                data = self.sendbuffer
+            else:
+                data = self.sendbuffer[:limit - total]
+            try:
+                sent = self.socket.send(data)
+            except (BlockingIOError, InterruptedError):
+                # Socket is full, wait for select to say it is writable
+                break
+            except socket.error:
+                self.quit("Write error: Connection reset by peer")
+                break
+            del self.sendbuffer[:sent]
+            total += sent
+            if sent < len(data):
+                break
+            self.fill()
+        return total
     
     def send(self, command, data):
         self._send(":%s %s %s %s" % (self.server.hostname, command, self.nickname, data))
@@ -97,125 +220,120 @@ class User:
     def send_numeric(self, numeric, data):
         self.send(str(numeric).rjust(3, "0"), data)
     
+    def numeric(self, numeric, data):
+        """Format a numeric reply without sending it, for send_paced"""
+        return ":%s %s %s %s" % (self.server.hostname, str(numeric).rjust(3, "0"), self.nickname, data)
+    
     def broadcast(self, users, data):
+        # Encode once, every recipient gets the same bytes
+        line = encode(":%s %s\r\n" % (self.fullname(), data))
         for user in users:
-            user._send(":%s %s" % (self.fullname(), data))
+            user.write(line)
     
     def welcome(self):
-        self.send_numeric(001, ":Welcome to %s, %s" % (self.server.name, self.fullname()))
-        self.send_numeric(002, ":Your host is %s, running version %s" % (self.server.hostname, self.server.version))
-        self.send_numeric(003, ":This server was created %s" % self.server.creationtime)
-        self.send_numeric(004, "%s %s  bov" % (self.server.hostname, self.server.version))
+        # K-Lines are checked once the user has registered
+        kline = self.server.bans.match_user(self)
+        if kline:
+            self.quit("K-Lined: %s" % kline.reason)
+            return
+        
+        self.server.index(self)
+        
+        self.send_numeric(1, ":Welcome to %s, %s" % (self.server.name, self.fullname()))
+        self.send_numeric(2, ":Your host is %s, running version %s" % (self.server.hostname, self.server.version))
+        self.send_numeric(3, ":This server was created %s" % self.server.creationtime)
+        self.send_numeric(4, "%s %s  DbeIimnotv" % (self.server.hostname, self.server.version))
         # http://www.irc.org/tech_docs/005.html
-        self.send_numeric(005, "CHANTYPES=# PREFIX=(ov)@+ CHANMODES=b,,,mnt NICKLEN=16 CHANNELLEN=50 TOPICLEN=300 AWAYLEN=160 NETWORK=%s :Are supported by this server" % self.server.name)
+        self.send_numeric(5, "CHANTYPES=# PREFIX=(ov)@+ CHANMODES=beI,,,Dimnt EXCEPTS INVEX WHOX NICKLEN=16 CHANNELLEN=50 TOPICLEN=300 AWAYLEN=160 NETWORK=%s :Are supported by this server" % self.server.name)
+        if config.history_length:
+            self.send_numeric(5, "CHATHISTORY=%d :Are supported by this server" % config.history_batch)
         # MOTD
         self.handle_MOTD(("MOTD",))
     
-    def quit(self, reason):
-        # Send error to user
+    def neighbors(self):
+        """Set of users who can see this user in a shared channel"""
+        users = set()
+        for channel in self.channels:
+            if self not in channel.hidden:
+                users.update(channel.users)
+        return users
+    
+    def disconnect(self, reason):
+        # Send error to user, after replies still held back by the cork
         try:
-            self.socket.send("ERROR :Closing link: (%s) [%s]\r\n" % (self.fullname(), reason))
+            self.socket.send(bytes(self.sendbuffer) + encode("ERROR :Closing link: (%s) [%s]\r\n" % (self.fullname(), reason)))
         except socket.error:
             pass
         
         # Close socket
         self.socket.close()
         
-        # Don't quit if already quitted
-        #if self not in self.server.users:
-        #    return
-        
-        # Send quit to all users in channels user is in
-        users = []
-        for channel in self.channels:
-            for user in channel.users:
-                if user not in users:
-                    users.append(user)
-        self.broadcast(users, "QUIT :%s" % reason)
-        
-        # Remove user from all channels
-        for channel in [channel for channel in self.server.channels if self in channel.users]:
-            if self in channel.users:
-                channel.users.remove(self)
-            if self in channel.usermodes.keys():
-                channel.usermodes.pop(self)
-        
-        # Remove user from server users
-        if self in self.server.users:
-            self.server.users.remove(self)
-        
-        # This User object should now be garbage collected...
+        # Drop anything still waiting to be read or written
+        del self.recvbuffer[:]
+        del self.sendbuffer[:]
+        self.pending.clear()
+    
+    def quit(self, reason):
+        self.server.quit([(self, reason)])
     
     def handle_recv(self):
-        while self.recvbuffer.find("\n") != -1:
-            recv = self.recvbuffer[:self.recvbuffer.find("\n")]
-            self.recvbuffer = self.recvbuffer[self.recvbuffer.find("\n")+1:]
+        self.throttled = False
+        buffer = self.recvbuffer
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
             
-            self.ping = time.time()
+            # Commands spend budget, which refills at config.flood_rate points
+            # per second. Once it runs out, the rest of the buffer waits.
+            now = time.time()
+            self.budget = min(config.flood_burst, self.budget + (now - self.budget_time) * config.flood_rate)
+            self.budget_time = now
+            if self.budget < 1:
+                self.throttled = True
+                self.server.schedule(now + (1 - self.budget) / config.flood_rate, self)
+                break
             
-            recv = recv.strip()
+            recv = decode(buffer[start:end].strip(b" \r"))
+            start = end + 1
+            
+            self.ping = now
             
             if recv == '':
                 continue
             
-            #print self, recv
+            #print(self, recv)
             
             parsed = self.parse_command(recv)
             command = parsed[0]
-            if command.upper() == "PING":
-                self.handle_PING(parsed)
-            elif command.upper() == "PONG":
-                pass
-            elif command.upper() == "NICK":
-                self.handle_NICK(parsed)
-            elif command.upper() == "USER":
-                self.handle_USER(parsed)
-            elif self.nickname == '*' or self.username == 'unknown':
+            handler, cost, registration = self.commands.get(command.upper(), (None, 1, True))
+            
+            if not self.oper:
+                # A comma separated JOIN or PART costs as much as one line per channel
+                if command.upper() in ("JOIN", "PART") and len(parsed) > 1:
+                    cost *= parsed[1].count(',') + 1
+                self.budget -= cost
+            
+            if registration and (self.nickname == '*' or self.username == 'unknown' or self.capneg):
                 self.send_numeric(451, "%s :You have not registered" % command)
-            elif command.upper() == "MOTD":
-                self.handle_MOTD(parsed)
-            elif command.upper() == "PRIVMSG":
-                self.handle_PRIVMSG(parsed)
-            elif command.upper() == "NOTICE":
-                self.handle_NOTICE(parsed)
-            elif command.upper() == "JOIN":
-                self.handle_JOIN(parsed)
-            elif command.upper() == "PART":
-                self.handle_PART(parsed)
-            elif command.upper() == "NAMES":
-                self.handle_NAMES(parsed)
-            elif command.upper() == "TOPIC":
-                self.handle_TOPIC(parsed)
-            elif command.upper() == "ISON":
-                self.handle_ISON(parsed)
-            elif command.upper() == "AWAY":
-                self.handle_AWAY(parsed)
-            elif command.upper() == "MODE":
-                self.handle_MODE(parsed)
-            elif command.upper() == "WHOIS":
-                self.handle_WHOIS(parsed)
-            elif command.upper() == "WHO":
-                self.handle_WHO(parsed)
-            elif command.upper() == "KICK":
-                self.handle_KICK(parsed)
-            elif command.upper() == "VERSION":
-                self.handle_VERSION(parsed)
-            elif command.upper() == "LIST":
-                self.handle_LIST(parsed)
-            elif command.upper() == "INVITE":
-                self.handle_INVITE(parsed)
-            elif command.upper() == "USERHOST":
-                self.handle_USERHOST(parsed)
-            elif command.upper() == "QUIT":
-                self.handle_QUIT(parsed)
-            else:
+            elif handler is None:
                 self.send_numeric(421, "%s :Unknown command" % command)
+            else:
+                getattr(self, handler)(parsed)
+        
+        # Drop the lines that were handled (quit may have emptied the buffer)
+        del buffer[:start]
+    
+    def handle_PONG(self, recv):
+        pass
     
     def handle_PING(self, recv):
         if len(recv) < 2:
             self.send_numeric(461, "PING :Not enough parameters")
             return
         self._send(":%s PONG %s :%s" % (self.server.hostname, self.server.hostname, recv[1]))
+        self.urgent = True
     
     def handle_MOTD(self, recv):
         self.send_numeric(375, ":%s message of the day" % self.server.hostname)
@@ -258,16 +376,22 @@ class User:
         # Nick is AWWW RIGHT
         self.broadcast([self], "NICK :%s" % nick)
         # Broadcast to all channels user is in
-        users = []
-        for channel in self.channels:
-            for user in channel.users:
-                if user not in users and user != self:
-                    users.append(user)
+        users = self.neighbors()
+        users.discard(self)
         self.broadcast(users, "NICK :%s" % nick)
         old = self.nickname
+        indexed = self in self.server.nicks.get(old)
+        if indexed:
+            self.server.unindex(self)
         self.nickname = nick
+        if indexed:
+            self.server.index(self)
+        
+        # Bans may match differently under the new nick
+        for channel in self.channels:
+            channel.banned.pop(self, None)
         
-        if old == "*" and self.username != "unknown":
+        if old == "*" and self.username != "unknown" and not self.capneg:
             self.welcome()
     
     def handle_USER(self, recv):
@@ -286,7 +410,7 @@ class User:
         self.username = username
         self.realname = realname
         
-        if self.nickname != '*':
+        if self.nickname != '*' and not self.capneg:
             self.welcome()
     
     def handle_PRIVMSG(self, recv):
@@ -315,7 +439,6 @@ class User:
         if target[0] != "#":
             # Find user
             user = [user for user in self.server.users if user.nickname.lower() == target.lower()]
-            #user = filter(lambda u: u.nickname.lower() == target.lower(), self.server.users)
             
             # User does not exist
             if user == []:
@@ -327,6 +450,7 @@ class User:
             
             # Broadcast message
             self.broadcast(user, "PRIVMSG %s :%s" % (target, msg))
+            user[0].urgent = True
         else:
             # Find channel
             channel = [channel for channel in self.server.channels if channel.name.lower() == target.lower()]
@@ -340,12 +464,17 @@ class User:
                 self.send_numeric(404, "%s :Cannot send to channel" % channel.name)
                 return
             
-            if 'm' in channel.modes and channel.usermodes[self] == '':
+            if 'm' in channel.modes and channel.usermodes.get(self, '') == '':
+                self.send_numeric(404, "%s :Cannot send to channel" % channel.name)
+                return
+            
+            if channel.usermodes.get(self, '') == '' and channel.is_banned(self):
                 self.send_numeric(404, "%s :Cannot send to channel" % channel.name)
                 return
             
             # Broadcast message
-            self.broadcast([user for user in channel.users if user != self], "PRIVMSG %s :%s" % (target, msg))
+            channel.reveal(self)
+            channel.message(self, "PRIVMSG %s :%s" % (target, msg))
     
     def handle_NOTICE(self, recv):
         if len(recv) < 2:
@@ -361,7 +490,7 @@ class User:
         # Notice to user
         if target[0] != "#":
             # Find user
-            user = filter(lambda u: u.nickname.lower() == target.lower(), self.server.users)
+            user = [u for u in self.server.users if u.nickname.lower() == target.lower()]
             
             # User does not exist
             if user == []:
@@ -372,14 +501,19 @@ class User:
             self.broadcast(user, "NOTICE %s :%s" % (target, msg))
         else:
             # Find channel
-            channel = filter(lambda c: c.name.lower() == target.lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == target.lower()]
             
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % target)
                 return
             
+            if channel[0].usermodes.get(self, '') == '' and channel[0].is_banned(self):
+                self.send_numeric(404, "%s :Cannot send to channel" % channel[0].name)
+                return
+            
             # Broadcast message
-            self.broadcast([user for user in channel[0].users if user != self], "NOTICE %s :%s" % (target, msg))
+            channel[0].reveal(self)
+            channel[0].message(self, "NOTICE %s :%s" % (target, msg))
     
     def handle_JOIN(self, recv):
         if len(recv) < 2:
@@ -413,12 +547,15 @@ class User:
                 self.send_numeric(479, "%s :Illegal channel name" % recv[1])
                 return
         
-        channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+        channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
         
-        # Create non-existent channel
+        # Create non-existent channel, with its saved state if there is any
         if channel == []:
             new = Channel(recv[1])
             self.server.channels.append(new)
+            new.restored = self.server.store.restore(new)
+            if not new.restored:
+                self.server.store.mark(new)
             channel = [new]
         
         channel = channel[0]
@@ -427,6 +564,19 @@ class User:
         if channel in self.channels:
             return
         
+        invited = channel.name.lower() in self.invites
+        
+        if 'i' in channel.modes and not invited and not channel.matches('I', self):
+            self.send_numeric(473, "%s :Cannot join channel (+i)" % channel.name)
+            return
+        
+        if channel.is_banned(self):
+            self.send_numeric(474, "%s :Cannot join channel (+b)" % channel.name)
+            return
+        
+        if invited:
+            self.invites.remove(channel.name.lower())
+        
         if channel.users == []:
             channel.usermodes[self] = 'o'
         else:
@@ -435,14 +585,25 @@ class User:
         channel.users.append(self)
         self.channels.append(channel)
         
-        self.broadcast(channel.users, "JOIN :%s" % channel.name)
+        restored = channel.restored
+        channel.restored = False
+        
+        if 'D' in channel.modes and channel.usermodes[self] == '':
+            # Delayed join, the others see it once this user speaks or is voiced
+            channel.hidden.add(self)
+            self.broadcast([self], "JOIN :%s" % channel.name)
+        else:
+            self.broadcast(channel.users, "JOIN :%s" % channel.name)
         if channel.topic_time != 0:
             self.handle_TOPIC(("TOPIC", channel.name))
         self.handle_NAMES(("NAMES", channel.name))
         if channel.users == [self]:
             channel.usermodes[self] = 'o'
-            channel.modes = "nt"
-            self._send(":%s MODE %s +nt" % (self.server.hostname, channel.name))
+            if not restored:
+                channel.modes = "nt"
+                self.server.store.mark(channel)
+            if channel.modes:
+                self._send(":%s MODE %s +%s" % (self.server.hostname, channel.name, channel.modes))
             self._send(":%s MODE %s +o %s" % (self.server.hostname, channel.name, self.nickname))
     
     def handle_PART(self, recv):
@@ -450,30 +611,48 @@ class User:
             self.send_numeric(461, "PART :Not enough parameters")
             return
         
+        if ',' in recv[1]:
+            for channel in recv[1].split(','):
+                self.handle_PART(("PART", channel) + tuple(recv[2:]))
+            return
+        
         target = recv[1]
         if len(recv) > 2:
             reason = recv[2]
         else:
             reason = ""
         
-        channel = filter(lambda c: c.name.lower() == target.lower(), self.channels)
+        channel = [c for c in self.channels if c.name.lower() == target.lower()]
         
         if channel == []:
             self.send_numeric(442, "%s :You're not on that channel" % target)
             return
         
         channel = channel[0]
-        self.broadcast(channel.users, "PART %s :%s" % (channel.name, reason))
+        if self in channel.hidden:
+            channel.hidden.discard(self)
+            self.broadcast([self], "PART %s :%s" % (channel.name, reason))
+        else:
+            self.broadcast(channel.users, "PART %s :%s" % (channel.name, reason))
         self.channels.remove(channel)
         channel.users.remove(self)
         channel.usermodes.pop(self)
+        channel.banned.pop(self, None)
     
     def handle_NAMES(self, recv):
         if len(recv) < 2:
             self.send_numeric(461, "NAMES :Not enough parameters")
             return
         
-        channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+        # NAMES -d #channel lists the members hidden by +D, as in ircu
+        delayed = recv[1] == "-d"
+        if delayed:
+            if len(recv) < 3:
+                self.send_numeric(461, "NAMES :Not enough parameters")
+                return
+            recv = recv[1:]
+        
+        channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
 
         if channel == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[1])
@@ -481,9 +660,18 @@ class User:
         
         channel = channel[0]
         
+        if delayed:
+            if 'o' not in channel.usermodes.get(self, ''):
+                self.send_numeric(482, "%s :You're not a channel operator" % channel.name)
+                return
+            hidden = [user.nickname for user in channel.users if user in channel.hidden]
+            self.send_numeric(355, "@ %s :%s" % (channel.name, " ".join(hidden)))
+            self.send_numeric(366, "%s :End of /NAMES list." % channel.name)
+            return
+        
         users = []
         
-        for user in channel.users:
+        for user in channel.visible(self):
             if 'o' in channel.usermodes[user]:
                 users.append('@'+user.nickname)
             elif 'v' in channel.usermodes[user]:
@@ -501,7 +689,7 @@ class User:
         
         if len(recv) < 3:
             # Send back topic
-            channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
                 return
@@ -515,7 +703,7 @@ class User:
             self.send_numeric(333, "%s %s %d" % (channel.name, channel.topic_author, channel.topic_time))
         else:
             # Set topic
-            channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
                 return
@@ -532,7 +720,9 @@ class User:
             channel.topic = recv[2][:300]
             channel.topic_author = self.fullname()
             channel.topic_time = int(time.time())
+            self.server.store.mark(channel)
             
+            channel.reveal(self)
             self.broadcast(channel.users, "TOPIC %s :%s" % (channel.name, channel.topic))
     
     def handle_ISON(self, recv):
@@ -561,7 +751,7 @@ class User:
         elif len(recv) == 2:
             # /mode #channel, send back channel modes
             
-            channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
                 return
@@ -570,20 +760,29 @@ class User:
             self.send_numeric(324, "%s +%s" % (channel.name, channel.modes))
             self.send_numeric(329, "%s %d" % (channel.name, channel.creation))
         elif len(recv) == 3:
-            # /mode #channel +mnt
+            # /mode #channel +mnt, or /mode #channel +b to list bans
             
-            channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
                 return
             channel = channel[0]
             
+            # List modes without a mask send back the list
+            for m in recv[2]:
+                if m in "beI":
+                    self.send_mask_list(channel, m)
+            
+            modes = ''.join([m for m in recv[2] if m not in "beIov"])
+            if modes.strip("+-") == '':
+                return
+            
             if self not in channel.users or 'o' not in channel.usermodes[self]:
                 self.send_numeric(482, "%s :You're not a channel operator" % channel.name)
                 return
             
             action = ''
-            for m in recv[2]:
+            for m in modes:
                 if m == '+':
                     action = '+'
                 elif m == '-':
@@ -594,12 +793,13 @@ class User:
                             channel.modes += m
                     elif action == '-':
                         channel.modes = channel.modes.replace(m, '')
+            self.server.store.mark(channel)
             
-            self.broadcast(channel.users, "MODE %s %s" % (channel.name, recv[2]))
+            self.broadcast(channel.users, "MODE %s %s" % (channel.name, modes))
         else:
             # /mode #channel +o-v user1 user2
             
-            channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+            channel = [c for c in self.server.channels if c.name.lower() == recv[1].lower()]
             if channel == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
                 return
@@ -616,27 +816,54 @@ class User:
                     action = '+'
                 elif m == '-':
                     action = '-'
-                elif m in "ov":
+                elif m in "ovbeI":
                     modes.append(action + m)
             modes = zip(recv[3:], modes)
             
-            for nick, mode in modes:
-                user = filter(lambda u: u.nickname.lower() == nick.lower(), channel.users)
+            # Only broadcast the changes that actually took effect
+            applied = []
+            for param, mode in modes:
+                if mode[1] in "beI":
+                    mask = normalize_mask(param)
+                    if channel.set_mask(mode[1], mask, self.fullname(), mode[0] == '+'):
+                        applied.append((mode, mask))
+                        self.server.store.mark(channel)
+                    continue
+                user = [u for u in channel.users if u.nickname.lower() == param.lower()]
                 if user != []:
                     user = user[0]
                     if mode[0] == '+':
                         channel.usermodes[user] += mode[1]
+                        channel.reveal(user)
                     else:
                         channel.usermodes[user] = channel.usermodes[user].replace(mode[1], "")
+                    applied.append((mode, user.nickname))
+            
+            if applied == []:
+                return
             
-            self.broadcast(channel.users, "MODE %s %s %s" % (channel.name, recv[2], ' '.join(recv[3:])))
+            modestring = ''
+            action = ''
+            for mode, param in applied:
+                if mode[0] != action:
+                    action = mode[0]
+                    modestring += action
+                modestring += mode[1]
+            
+            self.broadcast(channel.users, "MODE %s %s %s" % (channel.name, modestring, ' '.join([param for mode, param in applied])))
+    
+    def send_mask_list(self, channel, mode):
+        entry, end, name = {'b': (367, 368, "Ban"), 'e': (348, 349, "Exception"), 'I': (346, 347, "Invite")}[mode]
+        for mask, setter, set_time in channel.lists[mode]:
+            self.send_numeric(entry, "%s %s %s %d" % (channel.name, mask, setter, set_time))
+        self.send_numeric(end, "%s :End of Channel %s List" % (channel.name, name))
     
     def handle_WHOIS(self, recv):
         if len(recv) < 2:
             self.send_numeric(461, "WHOIS :Not enough parameters")
             return
         
-        user = filter(lambda u: u.nickname.lower() == recv[1].lower(), self.server.users)
+        user = [u for u in self.server.users if u.nickname.lower() == recv[1].lower()]
         
         if user == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[1])
@@ -665,22 +892,82 @@ class User:
         if len(recv) < 2:
             self.send_numeric(461, "WHO :Not enough parameters")
             return
+        mask = recv[1]
         
-        channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.server.channels)
+        # WHOX: WHO <mask> [<match flags>][%<fields>[,<token>]]
+        flags = ''
+        fields = None
+        token = "0"
+        if len(recv) > 2:
+            flags = recv[2]
+            if '%' in flags:
+                flags, fields = flags.split('%', 1)
+                if ',' in fields:
+                    fields, token = fields.split(',', 1)
+                    if not token.isdigit() or len(token) > 3:
+                        token = "0"
+        
+        if mask.startswith('#'):
+            channel = [c for c in self.server.channels if c.name.lower() == mask.lower()]
+            if channel == []:
+                users = []
+            else:
+                channel = channel[0]
+                users = channel.visible(self)
+        else:
+            channel = None
+            if mask == "0":
+                mask = "*"
+            # Without match flags the indexed fields are searched, IPs only by opers
+            match = flags.replace('o', '') or "nhis"
+            if not self.oper:
+                match = match.replace('i', '')
+            if match:
+                users = self.server.lookup(mask, match)
+            else:
+                users = []
         
-        if channel == []:
-            self.send_numeric(315, "%s :End of /WHO list." % recv[1])
-            return
-        channel = channel[0]
+        if 'o' in flags:
+            users = [user for user in users if user.oper]
         
-        for user in channel.users:
+        lines = [self.who_reply(channel, user, fields, token) for user in users]
+        lines.append(self.numeric(315, "%s :End of /WHO list." % mask))
+        self.send_paced(lines)
+    
+    def who_reply(self, channel, user, fields, token):
+        if channel is None:
+            name = '*'
+            modes = ''
+        else:
+            name = channel.name
             modes = ''.join([{'o': '@', 'v': '+'}[x] for x in channel.usermodes[user]])
-            if user.away:
-                away = 'G'
-            else:
-                away = 'H'
-            self.send_numeric(352, "%s %s %s %s %s %s%s :0 %s" % (channel.name, user.username, user.hostname, self.server.hostname, user.nickname, away, modes, user.realname))
-        self.send_numeric(315, "%s :End of /WHO list." % channel.name)
+        if user.away:
+            away = 'G'
+        else:
+            away = 'H'
+        if user.oper:
+            away += '*'
+        
+        if fields is None:
+            return self.numeric(352, "%s %s %s %s %s %s%s :0 %s" % (name, user.username, user.hostname, self.server.hostname, user.nickname, away, modes, user.realname))
+        
+        # WHOX fields are always sent in this order, realname last
+        values = {
+            't': token,
+            'c': name,
+            'u': user.username,
+            'i': user.ip if self.oper else "255.255.255.255",
+            'h': user.hostname,
+            's': self.server.hostname,
+            'n': user.nickname,
+            'f': away + modes,
+            'd': "0",
+            'l': str(int(time.time()) - int(user.ping)),
+            'a': "0",
+            'o': "n/a",
+            'r': ":" + user.realname,
+        }
+        return self.numeric(354, " ".join([values[x] for x in "tcuihsnfdlaor" if x in fields]))
     
     def handle_KICK(self, recv):
         if len(recv) < 3:
@@ -691,14 +978,14 @@ class User:
         else:
             reason = recv[3]
         
-        channel = filter(lambda c: c.name.lower() == recv[1].lower(), self.channels)
+        channel = [c for c in self.channels if c.name.lower() == recv[1].lower()]
         
         if channel == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[1])
             return
         channel = channel[0]
         
-        user = filter(lambda u: u.nickname.lower() == recv[2].lower(), channel.users)
+        user = [u for u in channel.users if u.nickname.lower() == recv[2].lower()]
         
         if user == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[2])
@@ -709,24 +996,30 @@ class User:
             self.send_numeric(482, "%s :You're not a channel operator" % channel.name)
             return
         
-        self.broadcast(channel.users, "KICK %s %s :%s" % (channel.name, user.nickname, reason))
+        if user in channel.hidden:
+            channel.hidden.discard(user)
+            self.broadcast(set([self, user]), "KICK %s %s :%s" % (channel.name, user.nickname, reason))
+        else:
+            self.broadcast(channel.users, "KICK %s %s :%s" % (channel.name, user.nickname, reason))
         
         user.channels.remove(channel)
         channel.users.remove(user)
         channel.usermodes.pop(user)
+        channel.banned.pop(user, None)
     
     def handle_LIST(self, recv):
-        self.send_numeric(321, "Channel :Users  Name")
+        lines = [self.numeric(321, "Channel :Users  Name")]
         for channel in self.server.channels:
-            self.send_numeric(322, "%s %d :%s" % (channel.name, len(channel.users), channel.topic))
-        self.send_numeric(323, ":End of /LIST")
+            lines.append(self.numeric(322, "%s %d :%s" % (channel.name, len(channel.users), channel.topic)))
+        lines.append(self.numeric(323, ":End of /LIST"))
+        self.send_paced(lines)
     
     def handle_INVITE(self, recv):
         if len(recv) < 3:
             self.send_numeric(461, "INVITE :Not enough parameters")
             return
 
-        user = filter(lambda u: u.nickname.lower() == recv[1].lower(), self.server.users)
+        user = [u for u in self.server.users if u.nickname.lower() == recv[1].lower()]
 
         if user == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[1])
@@ -734,7 +1027,7 @@ class User:
 
         user = user[0]
         
-        channel = filter(lambda c: c.name.lower() == recv[2].lower(), self.channels)
+        channel = [c for c in self.channels if c.name.lower() == recv[2].lower()]
         
         if channel == []:
             self.send_numeric(401, "%s :No such nick/channel" % recv[2])
@@ -749,6 +1042,13 @@ class User:
         if user in channel.users:
             self.send_numeric(443, "%s %s :is already on channel" % (user.nickname, channel.name))
             return
+        
+        if 'i' in channel.modes and 'o' not in channel.usermodes[self]:
+            self.send_numeric(482, "%s :You're not a channel operator" % channel.name)
+            return
+        
+        if channel.name.lower() not in user.invites:
+            user.invites.append(channel.name.lower())
 
         # Send invite to user
         self.broadcast([user], "INVITE %s %s" % (user.nickname, channel.name))
@@ -762,7 +1062,7 @@ class User:
             return
 
         for nick in recv[1:]:
-            user = filter(lambda u: u.nickname.lower() == nick.lower(), self.server.users)
+            user = [u for u in self.server.users if u.nickname.lower() == nick.lower()]
             
             if user == []:
                 self.send_numeric(401, "%s :No such nick/channel" % recv[1])
@@ -779,6 +1079,708 @@ class User:
             reason = self.nickname
         
         self.quit("Quit: " + reason)
+    
+    def handle_OPER(self, recv):
+        if len(recv) < 3:
+            self.send_numeric(461, "OPER :Not enough parameters")
+            return
+        
+        if recv[1] not in config.opers or config.opers[recv[1]] != recv[2]:
+            self.send_numeric(464, ":Password incorrect")
+            return
+        
+        self.oper = True
+        self.send_numeric(381, ":You are now an IRC operator")
+    
+    def add_ban(self, kind, recv):
+        command = {'K': "KLINE", 'Z': "ZLINE"}[kind]
+        
+        if not self.oper:
+            self.send_numeric(481, ":Permission Denied- You're not an IRC operator")
+            return
+        
+        # /kline [minutes] mask :reason
+        args = list(recv[1:])
+        duration = 0
+        if len(args) > 1 and args[0].isdigit():
+            duration = int(args.pop(0)) * 60
+        
+        if len(args) < 1:
+            self.send_numeric(461, "%s :Not enough parameters" % command)
+            return
+        
+        mask = args[0]
+        if len(args) > 1:
+            reason = args[1][:160]
+        else:
+            reason = "No reason"
+        
+        if kind == 'K' and '@' not in mask:
+            mask = "*@" + mask
+        if kind == 'Z' and parse_cidr(mask) is None:
+            self.send("NOTICE", ":Invalid Z-Line mask %s" % mask)
+            return
+        
+        if duration:
+            expires = int(time.time()) + duration
+        else:
+            expires = 0
+        
+        ban = Ban(kind, mask, reason, self.nickname, expires=expires)
+        self.server.bans.add(ban)
+        self.send("NOTICE", ":Added %s-Line for %s" % (kind, mask))
+        
+        # Apply the new ban to users that are already connected
+        for user in [user for user in self.server.users if ban.matches(user)]:
+            user.quit("%s-Lined: %s" % (kind, reason))
+    
+    def remove_ban(self, kind, recv):
+        command = {'K': "UNKLINE", 'Z': "UNZLINE"}[kind]
+        
+        if not self.oper:
+            self.send_numeric(481, ":Permission Denied- You're not an IRC operator")
+            return
+        
+        if len(recv) < 2:
+            self.send_numeric(461, "%s :Not enough parameters" % command)
+            return
+        
+        mask = recv[1]
+        if kind == 'K' and '@' not in mask:
+            mask = "*@" + mask
+        
+        if self.server.bans.remove(kind, mask):
+            self.send("NOTICE", ":Removed %s-Line for %s" % (kind, mask))
+        else:
+            self.send("NOTICE", ":No %s-Line for %s" % (kind, mask))
+    
+    def handle_KLINE(self, recv):
+        self.add_ban('K', recv)
+    
+    def handle_UNKLINE(self, recv):
+        self.remove_ban('K', recv)
+    
+    def handle_ZLINE(self, recv):
+        self.add_ban('Z', recv)
+    
+    def handle_UNZLINE(self, recv):
+        self.remove_ban('Z', recv)
+    
+    def handle_STATS(self, recv):
+        if len(recv) < 2 or recv[1] == '':
+            self.send_numeric(461, "STATS :Not enough parameters")
+            return
+        
+        letter = recv[1][0]
+        
+        if letter.upper() in "KZ":
+            if not self.oper:
+                self.send_numeric(481, ":Permission Denied- You're not an IRC operator")
+                return
+            for ban in self.server.bans.list(letter.upper()):
+                self.send_numeric(216, "%s %s %d %s :%s" % (ban.kind, ban.mask, ban.expires, ban.setter, ban.reason))
+        elif letter == 'h':
+            if not self.oper:
+                self.send_numeric(481, ":Permission Denied- You're not an IRC operator")
+                return
+            total = 0
+            for channel in [channel for channel in self.server.channels if channel.history]:
+                self.send_numeric(249, "h %s %d lines %d/%d bytes" % (channel.name, len(channel.history), channel.history.bytes, channel.history.size))
+                total += channel.history.bytes
+            self.send_numeric(249, "h * %d bytes total" % total)
+        
+        self.send_numeric(219, "%s :End of /STATS report" % letter)
+    
+    def handle_CAP(self, recv):
+        if len(recv) < 2:
+            self.send_numeric(461, "CAP :Not enough parameters")
+            return
+        
+        subcommand = recv[1].upper()
+        registered = self.nickname != '*' and self.username != 'unknown' and not self.capneg
+        
+        if subcommand == "LS":
+            if not registered:
+                self.capneg = True
+            self._send(":%s CAP %s LS :%s" % (self.server.hostname, self.nickname, " ".join(self.server.caps())))
+        elif subcommand == "LIST":
+            self._send(":%s CAP %s LIST :%s" % (self.server.hostname, self.nickname, " ".join(self.caps)))
+        elif subcommand == "REQ":
+            if not registered:
+                self.capneg = True
+            if len(recv) < 3:
+                requested = []
+            else:
+                requested = recv[2].split()
+            
+            # Requests are all or nothing
+            if [cap for cap in requested if cap.lstrip('-') not in self.server.caps()] != []:
+                self._send(":%s CAP %s NAK :%s" % (self.server.hostname, self.nickname, " ".join(requested)))
+                return
+            for cap in requested:
+                if cap.startswith('-'):
+                    if cap[1:] in self.caps:
+                        self.caps.remove(cap[1:])
+                elif cap not in self.caps:
+                    self.caps.append(cap)
+            self.tags = ("server-time" in self.caps, "message-tags" in self.caps)
+            self._send(":%s CAP %s ACK :%s" % (self.server.hostname, self.nickname, " ".join(requested)))
+        elif subcommand == "END":
+            if self.capneg:
+                self.capneg = False
+                if self.nickname != '*' and self.username != 'unknown':
+                    self.welcome()
+        else:
+            self.send_numeric(410, "%s :Invalid CAP command" % recv[1])
+    
+    def handle_CHATHISTORY(self, recv):
+        if len(recv) < 4:
+            self.send_numeric(461, "CHATHISTORY :Not enough parameters")
+            return
+        
+        subcommand = recv[1].upper()
+        
+        if subcommand not in ("LATEST", "BEFORE", "AFTER", "AROUND", "BETWEEN"):
+            self._send(":%s FAIL CHATHISTORY INVALID_PARAMS %s :Unknown subcommand" % (self.server.hostname, recv[1]))
+            return
+        
+        channel = [c for c in self.channels if c.name.lower() == recv[2].lower()]
+        
+        if channel == []:
+            self._send(":%s FAIL CHATHISTORY INVALID_TARGET %s %s :No history for target" % (self.server.hostname, subcommand, recv[2]))
+            return
+        channel = channel[0]
+        
+        # Selectors come before the limit, BETWEEN takes two
+        if subcommand == "BETWEEN":
+            if len(recv) < 6:
+                self.send_numeric(461, "CHATHISTORY :Not enough parameters")
+                return
+            selectors = recv[3:5]
+            limit = recv[5]
+        else:
+            if len(recv) < 5:
+                self.send_numeric(461, "CHATHISTORY :Not enough parameters")
+                return
+            selectors = recv[3:4]
+            limit = recv[4]
+        
+        if not limit.isdigit() or int(limit) == 0:
+            self._send(":%s FAIL CHATHISTORY INVALID_PARAMS %s :Invalid limit" % (self.server.hostname, subcommand))
+            return
+        limit = min(int(limit), config.history_batch)
+        
+        parsed = [parse_selector(selector) for selector in selectors]
+        if None in parsed or (subcommand != "LATEST" and '*' in parsed):
+            self._send(":%s FAIL CHATHISTORY INVALID_PARAMS %s :Invalid message reference" % (self.server.hostname, subcommand))
+            return
+        
+        if channel.history is None:
+            entries = []
+        else:
+            entries = channel.history.select(subcommand, parsed, limit)
+        
+        lines = []
+        if "batch" in self.caps:
+            self.server.msgid += 1
+            ref = "h%d" % self.server.msgid
+            lines.append(":%s BATCH +%s chathistory %s" % (self.server.hostname, ref, channel.name))
+        for msgid, timestamp, line in entries:
+            tags = []
+            if "batch" in self.caps:
+                tags.append("batch=" + ref)
+            if "server-time" in self.caps:
+                tags.append("time=" + server_time(timestamp))
+            if "message-tags" in self.caps:
+                tags.append("msgid=%d" % msgid)
+            if tags != []:
+                line = "@%s %s" % (";".join(tags), line)
+            lines.append(line)
+        if "batch" in self.caps:
+            lines.append(":%s BATCH -%s" % (self.server.hostname, ref))
+        
+        self.send_paced(lines)
+
+def mask_regex(mask):
+    """Translate an IRC wildcard mask (* and ?) into a regex pattern"""
+    regex = ''
+    for c in mask:
+        if c == '*':
+            if not regex.endswith('.*'):
+                regex += '.*'
+        elif c == '?':
+            regex += '.'
+        else:
+            regex += re.escape(c)
+    return regex
+
+def compile_mask(mask):
+    """Compile an IRC wildcard mask into a case-insensitive regex"""
+    return re.compile(mask_regex(mask) + r'\Z', re.I | re.S)
+
+def compile_masks(masks):
+    """Compile a list of masks into a single regex matching any of them"""
+    if masks == []:
+        return None
+    return re.compile(r"(?:%s)\Z" % "|".join([mask_regex(mask) for mask in masks]), re.I | re.S)
+
+def normalize_mask(mask):
+    """Expand a partial ban mask into a full nick!user@host mask"""
+    if '!' not in mask and '@' not in mask:
+        return mask + "!*@*"
+    if '!' not in mask:
+        return "*!" + mask
+    if '@' not in mask:
+        return mask + "@*"
+    return mask
+
+def parse_cidr(mask):
+    """Parse an IP or CIDR mask into (family, network, prefix length)"""
+    if '/' in mask:
+        ip, length = mask.split('/', 1)
+    else:
+        ip, length = mask, None
+    
+    if ':' in ip:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    
+    try:
+        packed = socket.inet_pton(family, ip)
+    except (socket.error, ValueError):
+        return None
+    
+    bits = len(packed) * 8
+    if length is None:
+        length = bits
+    elif not length.isdigit() or int(length) > bits:
+        return None
+    length = int(length)
+    
+    address = int(binascii.hexlify(packed), 16)
+    # Zero out host bits so 10.1.2.3/8 and 10.0.0.0/8 are the same network
+    address &= ((1 << length) - 1) << (bits - length)
+    return family, address, length
+
+class Ban:
+    def __init__(self, kind, mask, reason, setter, expires=0, creation=None):
+        self.kind = kind
+        self.mask = mask
+        self.reason = reason
+        self.setter = setter
+        self.expires = expires
+        if creation is None:
+            creation = int(time.time())
+        self.creation = creation
+        
+        self.cidr = None
+        if kind == 'Z':
+            self.cidr = parse_cidr(mask)
+            self.user = None
+            self.host = mask
+        else:
+            user, self.host = mask.split('@', 1)
+            self.user = compile_mask(user)
+            self.cidr = parse_cidr(self.host)
+            self.hostmask = compile_mask(self.host)
+    
+    def __repr__(self):
+        return "<Ban %s '%s'>" % (self.kind, self.mask)
+    
+    def key(self):
+        return (self.kind, self.mask.lower())
+    
+    def expired(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.expires != 0 and self.expires <= now
+    
+    def matches(self, user):
+        """Match this ban against a single user (slow path, no indexes)"""
+        if self.expired():
+            return False
+        if self.kind == 'Z':
+            return covers(self.cidr, user.ip)
+        if user.username == "unknown" or not self.user.match(user.username):
+            return False
+        if self.cidr:
+            return covers(self.cidr, user.ip)
+        return bool(self.hostmask.match(user.hostname) or self.hostmask.match(user.ip))
+
+def covers(cidr, ip):
+    """Check if an IP address falls within a parsed CIDR mask"""
+    parsed = parse_cidr(ip)
+    if parsed is None or parsed[0] != cidr[0]:
+        return False
+    family, network, length = cidr
+    bits = parsed[2]
+    return parsed[1] >> (bits - length) == network >> (bits - length)
+
+class PrefixNode(object):
+    __slots__ = ("address", "length", "children", "bans")
+    
+    def __init__(self, address, length, bans=None):
+        self.address = address
+        self.length = length
+        self.children = [None, None]
+        self.bans = bans
+
+class PrefixTrie:
+    """Path-compressed binary radix trie of IP prefixes
+    
+    A lookup visits at most one node per bit of the address, no matter
+    how many prefixes are stored.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = PrefixNode(0, 0)
+    
+    def bit(self, address, i):
+        return (address >> (self.bits - 1 - i)) & 1
+    
+    def common(self, a, b, length):
+        """Length of the common prefix of a and b, up to length bits"""
+        diff = (a ^ b) >> (self.bits - length)
+        return length - diff.bit_length()
+    
+    def insert(self, address, length, ban):
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.bans is None:
+                    node.bans = []
+                node.bans.append(ban)
+                return
+            
+            bit = self.bit(address, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = PrefixNode(address, length, [ban])
+                return
+            
+            common = self.common(child.address, address, min(child.length, length))
+            if common == child.length:
+                node = child
+                continue
+            
+            # Split the edge to child at the point where the prefixes diverge
+            if common == length:
+                new = PrefixNode(address, length, [ban])
+            else:
+                new = PrefixNode(address & (((1 << common) - 1) << (self.bits - common)), common)
+                new.children[self.bit(address, common)] = PrefixNode(address, length, [ban])
+            new.children[self.bit(child.address, common)] = child
+            node.children[bit] = new
+            return
+    
+    def remove(self, address, length, ban):
+        parent = None
+        node = self.root
+        while node is not None and node.length < length:
+            if self.common(node.address, address, node.length) != node.length:
+                return
+            parent = node
+            node = node.children[self.bit(address, node.length)]
+        
+        if node is None or node.length != length or node.address != address:
+            return
+        if node.bans and ban in node.bans:
+            node.bans.remove(ban)
+        if not node.bans:
+            node.bans = None
+            # Prune empty leaves
+            if parent is not None and node.children == [None, None]:
+                parent.children[parent.children.index(node)] = None
+    
+    def search(self, address):
+        """Yield the bans of every stored prefix covering address"""
+        node = self.root
+        while node is not None:
+            if self.common(node.address, address, node.length) != node.length:
+                return
+            if node.bans:
+                for ban in node.bans:
+                    yield ban
+            if node.length == self.bits:
+                return
+            node = node.children[self.bit(address, node.length)]
+
+class BanList:
+    """Server bans (K-Lines and Z-Lines)
+    
+    Z-Lines and CIDR K-Lines live in prefix tries, exact and *.domain
+    K-Line hosts in dicts, and only the remaining wildcard hosts are
+    matched one by one with their precompiled regexes. Every change is
+    appended to a journal file which is compacted on load.
+    """
+    def __init__(self, path):
+        self.path = path
+        
+        self.bans = {}
+        self.expiry = []
+        
+        self.zlines = {socket.AF_INET: PrefixTrie(32), socket.AF_INET6: PrefixTrie(128)}
+        self.kline_ips = {socket.AF_INET: PrefixTrie(32), socket.AF_INET6: PrefixTrie(128)}
+        self.kline_hosts = {}
+        self.kline_domains = {}
+        self.kline_masks = []
+        
+        self.load()
+    
+    def index(self, ban):
+        if ban.kind == 'Z':
+            family, address, length = ban.cidr
+            return self.zlines[family], (address, length)
+        if ban.cidr:
+            family, address, length = ban.cidr
+            return self.kline_ips[family], (address, length)
+        host = ban.host.lower()
+        if '*' not in host and '?' not in host:
+            return self.kline_hosts, host
+        if host.startswith('*.') and '*' not in host[2:] and '?' not in host:
+            return self.kline_domains, host[2:]
+        return self.kline_masks, None
+    
+    def add(self, ban, journal=True):
+        if ban.key() in self.bans:
+            self.remove(ban.kind, ban.mask, journal=False)
+        self.bans[ban.key()] = ban
+        
+        table, key = self.index(ban)
+        if isinstance(table, PrefixTrie):
+            table.insert(key[0], key[1], ban)
+        elif isinstance(table, dict):
+            table.setdefault(key, []).append(ban)
+        else:
+            table.append(ban)
+        
+        if ban.expires:
+            heapq.heappush(self.expiry, (ban.expires, ban.key()))
+        
+        if journal:
+            self.write(["ADD %s %s %d %d %s :%s" % (ban.kind, ban.mask, ban.creation, ban.expires, ban.setter, ban.reason)])
+    
+    def remove(self, kind, mask, journal=True):
+        ban = self.bans.pop((kind, mask.lower()), None)
+        if ban is None:
+            return None
+        
+        table, key = self.index(ban)
+        if isinstance(table, PrefixTrie):
+            table.remove(key[0], key[1], ban)
+        elif isinstance(table, dict):
+            table[key].remove(ban)
+            if not table[key]:
+                del table[key]
+        else:
+            table.remove(ban)
+        
+        if journal:
+            self.write(["DEL %s %s" % (ban.kind, ban.mask)])
+        return ban
+    
+    def list(self, kind):
+        return [ban for ban in self.bans.values() if ban.kind == kind and not ban.expired()]
+    
+    def match_ip(self, ip):
+        """Find a Z-Line covering ip"""
+        parsed = parse_cidr(ip)
+        if parsed is None:
+            return None
+        family, address, length = parsed
+        for ban in self.zlines[family].search(address):
+            if not ban.expired():
+                return ban
+        return None
+    
+    def match_user(self, user):
+        """Find a K-Line matching a registered user"""
+        candidates = []
+        
+        host = user.hostname.lower()
+        candidates += self.kline_hosts.get(host, [])
+        candidates += self.kline_hosts.get(user.ip, [])
+        
+        labels = host.split('.')
+        for i in range(1, len(labels)):
+            candidates += self.kline_domains.get('.'.join(labels[i:]), [])
+        
+        parsed = parse_cidr(user.ip)
+        if parsed is not None:
+            candidates += self.kline_ips[parsed[0]].search(parsed[1])
+        
+        for ban in candidates:
+            if not ban.expired() and ban.user.match(user.username):
+                return ban
+        
+        for ban in self.kline_masks:
+            if ban.matches(user):
+                return ban
+        return None
+    
+    def expire(self):
+        now = time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry)
+            ban = self.bans.get(key)
+            if ban is not None and ban.expired(now):
+                self.remove(ban.kind, ban.mask, journal=False)
+    
+    def write(self, lines):
+        if not self.path:
+            return
+        f = open(self.path, 'a', encoding="utf-8", errors="surrogateescape")
+        try:
+            for line in lines:
+                f.write(line + "\n")
+        finally:
+            f.close()
+    
+    def rewrite(self, lines):
+        """Replace the journal, so a crash leaves either the old or the new one"""
+        tmp = self.path + ".tmp"
+        f = open(tmp, 'w', encoding="utf-8", errors="surrogateescape")
+        try:
+            for line in lines:
+                f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+    
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        
+        f = open(self.path, encoding="utf-8", errors="surrogateescape", newline="\n")
+        try:
+            for line in f:
+                # Ignore a partially written last record
+                if not line.endswith("\n"):
+                    break
+                line = line.rstrip("\r\n")
+                if line.startswith("ADD "):
+                    try:
+                        words, reason = line.split(" :", 1)
+                        action, kind, mask, creation, expires, setter = words.split(' ')
+                        ban = Ban(kind, mask, reason, setter, int(expires), int(creation))
+                    except (ValueError, TypeError):
+                        # Skip a damaged record rather than refuse to start
+                        continue
+                    if not ban.expired():
+                        self.add(ban, journal=False)
+                elif line.startswith("DEL "):
+                    try:
+                        action, kind, mask = line.split(' ', 2)
+                    except ValueError:
+                        continue
+                    self.remove(kind, mask, journal=False)
+        finally:
+            f.close()
+        
+        # Compact the journal down to the bans that are still active
+        self.rewrite(["ADD %s %s %d %d %s :%s" % (ban.kind, ban.mask, ban.creation, ban.expires, ban.setter, ban.reason) for ban in self.bans.values()])
+
+def encode(text):
+    """Encode text for the wire
+    
+    Lines are decoded with surrogateescape, so bytes that were not valid
+    UTF-8 are passed through to other clients unchanged.
+    """
+    return text.encode("utf-8", "surrogateescape")
+
+def decode(data):
+    return data.decode("utf-8", "surrogateescape")
+
+def server_time(timestamp):
+    """Format a timestamp for the IRCv3 server-time tag"""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".%03dZ" % (int(timestamp * 1000) % 1000)
+
+def parse_selector(selector):
+    """Parse a CHATHISTORY message reference into (kind, value)"""
+    if selector == '*':
+        return '*'
+    if selector.startswith("msgid=") and selector[6:].isdigit():
+        return ("msgid", int(selector[6:]))
+    if selector.startswith("timestamp="):
+        value = selector[10:].rstrip('Z')
+        try:
+            seconds = calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+            if value[19:20] == '.':
+                seconds += float("0" + value[19:])
+        except ValueError:
+            return None
+        return ("timestamp", seconds)
+    return None
+
+class History:
+    """Ring buffer of a channel's most recent messages
+    
+    Messages are kept preformatted as (msgid, time, line) and the oldest
+    are dropped once either the line count or byte budget is exceeded.
+    """
+    def __init__(self, length, size):
+        self.length = length
+        self.size = size
+        self.bytes = 0
+        self.entries = collections.deque()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def add(self, msgid, timestamp, line):
+        self.entries.append((msgid, timestamp, line))
+        self.bytes += len(encode(line))
+        while len(self.entries) > self.length or self.bytes > self.size:
+            self.bytes -= len(encode(self.entries.popleft()[2]))
+    
+    def position(self, selector):
+        """Index of the first entry at or after selector"""
+        kind, value = selector
+        if kind == "msgid":
+            field = 0
+        else:
+            field = 1
+        for i, entry in enumerate(self.entries):
+            if entry[field] >= value:
+                return i
+        return len(self.entries)
+    
+    def after(self, selector):
+        """Index of the first entry strictly after selector"""
+        i = self.position(selector)
+        kind, value = selector
+        if kind == "msgid" and i < len(self.entries) and self.entries[i][0] == value:
+            i += 1
+        return i
+    
+    def select(self, subcommand, selectors, limit):
+        entries = list(self.entries)
+        # The last limit entries of a slice, explicitly, as [-0:] is everything
+        last = lambda entries: entries[max(0, len(entries) - limit):]
+        
+        if subcommand == "LATEST":
+            if selectors[0] == '*':
+                start = 0
+            else:
+                start = self.after(selectors[0])
+            return last(entries[start:])
+        elif subcommand == "BEFORE":
+            return last(entries[:self.position(selectors[0])])
+        elif subcommand == "AFTER":
+            return entries[self.after(selectors[0]):][:limit]
+        elif subcommand == "AROUND":
+            i = self.position(selectors[0])
+            start = max(0, i - limit // 2)
+            return entries[start:start + limit]
+        elif subcommand == "BETWEEN":
+            first, second = selectors
+            if first[1] <= second[1] or first[0] != second[0]:
+                return entries[self.after(first):self.position(second)][:limit]
+            return last(entries[self.after(second):self.position(first)])
+        return []
 
 class Channel:
     def __init__(self, name):
@@ -790,9 +1792,450 @@ class Channel:
         self.topic_author = ""
         self.topic_time = 0
         self.creation = int(time.time())
+        
+        # List modes: mode -> [(mask, setter, time)] and their compiled regexes,
+        # which are compiled on first use after a change
+        self.lists = {'b': [], 'e': [], 'I': []}
+        self.masks = {}
+        
+        # Member -> result of the last ban check
+        self.banned = {}
+        
+        # Members whose JOIN was held back by +D (see reveal)
+        self.hidden = set()
+        
+        self.history = None
+        
+        # Saved state was loaded but nobody has joined since
+        self.restored = False
     
     def __repr__(self):
         return "<Channel '%s'>" % self.name
+    
+    def matches(self, mode, user):
+        if mode not in self.masks:
+            self.masks[mode] = compile_masks([entry[0] for entry in self.lists[mode]])
+        mask = self.masks[mode]
+        if mask is None:
+            return False
+        if mask.match(user.fullname()):
+            return True
+        return bool(mask.match("%s!%s@%s" % (user.nickname, user.username, user.ip)))
+    
+    def visible(self, viewer):
+        """Members shown to viewer, hidden ones only to themselves
+        
+        Nobody is sent the JOIN, PART or QUIT of a hidden member, ops
+        included, so listing them would leave stale names behind. Ops
+        can ask for them with NAMES -d.
+        """
+        if not self.hidden:
+            return self.users
+        return [user for user in self.users if user not in self.hidden or user == viewer]
+    
+    def reveal(self, user):
+        """Send the held back JOIN of a hidden member"""
+        if user in self.hidden:
+            self.hidden.discard(user)
+            user.broadcast([member for member in self.users if member != user], "JOIN :%s" % self.name)
+    
+    def is_banned(self, user):
+        if user in self.banned:
+            return self.banned[user]
+        
+        banned = self.matches('b', user) and not self.matches('e', user)
+        
+        # Only cache members, so the cache is dropped on PART, KICK and QUIT
+        if user in self.usermodes:
+            self.banned[user] = banned
+        return banned
+    
+    def message(self, sender, data):
+        """Send a PRIVMSG or NOTICE to the other members and record it
+        
+        Members with server-time or message-tags get it tagged with its
+        time and msgid, which they can pass back to CHATHISTORY. Each
+        combination of tags is only encoded once.
+        """
+        server = sender.server
+        server.msgid += 1
+        msgid = server.msgid
+        now = time.time()
+        line = ":%s %s" % (sender.fullname(), data)
+        
+        encoded = {}
+        for user in self.users:
+            if user == sender:
+                continue
+            key = user.tags
+            if key not in encoded:
+                tags = []
+                if key[0]:
+                    tags.append("time=" + server_time(now))
+                if key[1]:
+                    tags.append("msgid=%d" % msgid)
+                if tags != []:
+                    encoded[key] = encode("@%s %s\r\n" % (";".join(tags), line))
+                else:
+                    encoded[key] = encode(line + "\r\n")
+            user.write(encoded[key])
+        
+        self.record(msgid, now, line)
+    
+    def record(self, msgid, timestamp, line):
+        """Save a message line to the channel history, if enabled"""
+        if not config.history_length:
+            return
+        if self.history is None:
+            self.history = History(config.history_length, config.history_size)
+        self.history.add(msgid, timestamp, line)
+    
+    def set_mask(self, mode, mask, setter, add):
+        entries = self.lists[mode]
+        existing = [entry for entry in entries if entry[0].lower() == mask.lower()]
+        
+        if add:
+            if existing != []:
+                return False
+            entries.append((mask, setter, int(time.time())))
+        else:
+            if existing == []:
+                return False
+            entries.remove(existing[0])
+        
+        self.masks.pop(mode, None)
+        self.banned.clear()
+        return True
+
+def serialize_channel(channel):
+    """Serialize the durable state of a channel into a single line"""
+    words = [channel.name, str(channel.creation), '+' + channel.modes, str(channel.topic_time), channel.topic_author or '*']
+    for mode in "beI":
+        words.append(str(len(channel.lists[mode])))
+        for mask, setter, set_time in channel.lists[mode]:
+            words += [mask, setter, str(set_time)]
+    # A CR or LF anywhere would split the record when it is read back
+    line = "%s :%s" % (" ".join(words), channel.topic)
+    return line.replace("\r", "").replace("\n", "")
+
+def unserialize_channel(channel, line):
+    words = line.split(' ')
+    channel.creation = int(words[1])
+    channel.modes = words[2][1:]
+    channel.topic_time = int(words[3])
+    if words[4] != '*':
+        channel.topic_author = words[4]
+    i = 5
+    for mode in "beI":
+        count = int(words[i])
+        i += 1
+        for n in range(count):
+            channel.lists[mode].append((words[i], words[i+1], int(words[i+2])))
+            i += 3
+    channel.masks = {}
+    # The topic is everything after the fixed fields, minus its colon
+    channel.topic = " ".join(words[i:])[1:]
+
+class ChannelStore:
+    """Durable channel state (creation time, modes, topic and mask lists)
+    
+    Each channel is kept as a single serialized line. Handlers only mark
+    channels as changed; the run loop appends them to the journal of the
+    current generation, and a background thread periodically writes a
+    snapshot of every line and deletes the journals it supersedes.
+    Saved state is applied when a channel is next created.
+    """
+    def __init__(self, path):
+        self.path = path
+        
+        # Lowercase name -> serialized line
+        self.lines = {}
+        # Lowercase name -> changed channel, or None if it was removed
+        self.dirty = {}
+        
+        self.generation = 0
+        self.changes = 0
+        self.snapshot_time = time.time()
+        self.thread = None
+        
+        self.load()
+    
+    def journal(self, generation):
+        return "%s.%d" % (self.path, generation)
+    
+    def generations(self):
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        return sorted([int(name[len(prefix):]) for name in os.listdir(directory) if name.startswith(prefix) and name[len(prefix):].isdigit()])
+    
+    def load(self):
+        if not self.path:
+            return
+        
+        snapshot = 0
+        if os.path.exists(self.path):
+            f = open(self.path, encoding="utf-8", errors="surrogateescape", newline="\n")
+            try:
+                snapshot = int(f.readline().split(' ')[1])
+                for line in f:
+                    self.load_line(line.rstrip("\n"))
+            finally:
+                f.close()
+        self.generation = snapshot
+        
+        for generation in self.generations():
+            if generation < snapshot:
+                # Left behind by an interrupted snapshot
+                os.remove(self.journal(generation))
+                continue
+            f = open(self.journal(generation), encoding="utf-8", errors="surrogateescape", newline="\n")
+            try:
+                for line in f:
+                    # Ignore a partially written last record
+                    if not line.endswith("\n"):
+                        break
+                    line = line[:-1]
+                    if line.startswith("SET "):
+                        self.load_line(line[4:])
+                    elif line.startswith("DEL "):
+                        self.lines.pop(line[4:], None)
+                    self.changes += 1
+            finally:
+                f.close()
+            self.generation = generation
+    
+    def load_line(self, line):
+        """Keep a saved channel line, skipping it if it does not parse"""
+        name = line.split(' ', 1)[0]
+        try:
+            unserialize_channel(Channel(name), line)
+        except (ValueError, IndexError):
+            return
+        self.lines[name.lower()] = line
+    
+    def restore(self, channel):
+        """Apply saved state to a newly created channel"""
+        line = self.lines.get(channel.name.lower())
+        if line is None:
+            return False
+        unserialize_channel(channel, line)
+        return True
+    
+    def mark(self, channel):
+        self.dirty[channel.name.lower()] = channel
+    
+    def drop(self, channel):
+        self.dirty[channel.name.lower()] = None
+    
+    def flush(self):
+        """Append changes since the last flush to the journal"""
+        if self.dirty == {}:
+            return
+        
+        records = []
+        for name, channel in self.dirty.items():
+            if channel is None:
+                if self.lines.pop(name, None) is not None:
+                    records.append("DEL " + name)
+            else:
+                line = serialize_channel(channel)
+                if self.lines.get(name) != line:
+                    self.lines[name] = line
+                    records.append("SET " + line)
+        self.dirty = {}
+        
+        if not self.path or records == []:
+            return
+        self.changes += len(records)
+        
+        f = open(self.journal(self.generation), 'a', encoding="utf-8", errors="surrogateescape", newline="\n")
+        try:
+            f.write("\n".join(records) + "\n")
+        finally:
+            f.close()
+    
+    def snapshot(self, wait=False):
+        """Compact everything into a new snapshot in the background"""
+        if self.thread is not None and self.thread.is_alive():
+            if not wait:
+                return
+            self.thread.join()
+        
+        self.flush()
+        self.snapshot_time = time.time()
+        if not self.path or self.changes == 0:
+            return
+        
+        # Later changes go to the next generation's journal
+        self.generation += 1
+        self.changes = 0
+        
+        self.thread = threading.Thread(target=self.write_snapshot, args=(list(self.lines.values()), self.generation))
+        self.thread.start()
+        if wait:
+            self.thread.join()
+    
+    def write_snapshot(self, lines, generation):
+        tmp = self.path + ".tmp"
+        f = open(tmp, 'w', encoding="utf-8", errors="surrogateescape", newline="\n")
+        try:
+            f.write("GEN %d\n" % generation)
+            for line in lines:
+                f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        
+        for old in self.generations():
+            if old < generation:
+                os.remove(self.journal(old))
+
+class Capture:
+    """Opt-in record of the lines clients send, for bench/replay.py
+    
+    One record per line: time, connection number, kind and data. Kind
+    '+' is a new connection from an IP, '>' a line from the client and
+    '-' a disconnect. OPER passwords are left out. Once the file reaches
+    capture_size bytes it is rotated to path.1, path.2 and so on,
+    keeping capture_keep old files.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        
+        # User -> connection number, and any partial line it has sent
+        self.connections = {}
+        self.tails = {}
+        self.count = 0
+        
+        if self.path:
+            self.open()
+    
+    def open(self):
+        self.file = open(self.path, "a", encoding="utf-8", errors="surrogateescape", newline="")
+        self.size = self.file.tell()
+    
+    def write(self, number, kind, data=None):
+        if data is None:
+            record = "%.6f %d %s\n" % (time.time(), number, kind)
+        else:
+            record = "%.6f %d %s %s\n" % (time.time(), number, kind, data)
+        self.file.write(record)
+        self.size += len(encode(record))
+        if self.size >= config.capture_size:
+            self.rotate()
+    
+    def connect(self, user):
+        if self.file is None:
+            return
+        self.count += 1
+        self.connections[user] = self.count
+        self.write(self.count, '+', user.ip)
+    
+    def receive(self, user, data):
+        if user not in self.connections:
+            return
+        lines = (self.tails.pop(user, b"") + data).split(b"\n")
+        tail = lines.pop()
+        if tail:
+            self.tails[user] = tail
+        for line in lines:
+            line = decode(line).rstrip("\r")
+            if line[:5].upper() == "OPER ":
+                line = " ".join(line.split(" ")[:2] + ["*"])
+            self.write(self.connections[user], '>', line)
+    
+    def disconnect(self, user):
+        if user not in self.connections:
+            return
+        self.write(self.connections.pop(user), '-')
+        self.tails.pop(user, None)
+    
+    def rotate(self):
+        self.file.close()
+        for n in range(config.capture_keep, 0, -1):
+            old = "%s.%d" % (self.path, n)
+            if not os.path.exists(old):
+                continue
+            if n == config.capture_keep:
+                os.remove(old)
+            else:
+                os.rename(old, "%s.%d" % (self.path, n + 1))
+        if config.capture_keep > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+    
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+class MaskIndex:
+    """Users bucketed by a lowercase key, searchable by wildcard mask
+    
+    Keys are kept sorted forwards and reversed, so a mask with a literal
+    prefix (nick*, 10.0.*) or suffix (*.example.com) only looks at the
+    keys sharing it.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.forward = []
+        self.backward = []
+    
+    def add(self, key, user):
+        key = key.lower()
+        if key not in self.buckets:
+            self.buckets[key] = set()
+            bisect.insort(self.forward, key)
+            bisect.insort(self.backward, key[::-1])
+        self.buckets[key].add(user)
+    
+    def remove(self, key, user):
+        key = key.lower()
+        bucket = self.buckets[key]
+        bucket.discard(user)
+        if not bucket:
+            del self.buckets[key]
+            del self.forward[bisect.bisect_left(self.forward, key)]
+            del self.backward[bisect.bisect_left(self.backward, key[::-1])]
+    
+    def get(self, key):
+        return self.buckets.get(key.lower(), set())
+    
+    def all(self):
+        return set().union(*self.buckets.values())
+    
+    def search(self, mask):
+        """Users whose key matches mask, None if there is nothing to narrow by"""
+        mask = mask.lower()
+        parts = re.split(r"[*?]", mask)
+        if len(parts) == 1:
+            return set(self.get(mask))
+        prefix, suffix = parts[0], parts[-1]
+        if prefix == '' and suffix == '':
+            return None
+        if len(prefix) >= len(suffix):
+            keys = prefixed(self.forward, prefix)
+        else:
+            keys = [key[::-1] for key in prefixed(self.backward, suffix[::-1])]
+        regex = compile_mask(mask)
+        users = set()
+        for key in keys:
+            if regex.match(key):
+                users.update(self.buckets[key])
+        return users
+
+def prefixed(keys, prefix):
+    """Keys starting with prefix from a sorted list"""
+    found = []
+    i = bisect.bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix):
+        found.append(keys[i])
+        i += 1
+    return found
 
 class Server(socket.socket):
     def __init__(self):
@@ -803,12 +2246,166 @@ class Server(socket.socket):
         
         self.hostcache = {}
         
+        # Registered users by nickname, hostname and IP for WHO (see lookup)
+        self.nicks = MaskIndex()
+        self.hosts = MaskIndex()
+        self.ips = MaskIndex()
+        
+        self.bans = BanList(config.bans_file)
+        
+        self.store = ChannelStore(config.channels_file)
+        
+        self.capture = Capture(config.capture_file)
+        
+        # Counter for history message IDs and batch references
+        self.msgid = 0
+        
+        # While corked, users with new output wait here to be flushed together
+        self.corked = False
+        self.corked_users = []
+        
+        # Counter for round robin turns at sending (see send_backlogs)
+        self.turns = 0
+        
+        # Heap of (time, sequence, user) for throttled users to resume input
+        self.scheduled = []
+        self.sequence = 0
+        
         self.hostname = config.hostname
         self.name = config.name
         self.creationtime = config.creation
         self.version = "omgircd-0.1.0"
         self.motd = config.motd
     
+    def queue_write(self, user):
+        """Called when a user's sendbuffer stops being empty"""
+        if self.corked:
+            self.corked_users.append(user)
+        else:
+            user.flush()
+    
+    def schedule(self, when, user):
+        self.sequence += 1
+        heapq.heappush(self.scheduled, (when, self.sequence, user))
+    
+    def index(self, user):
+        """Add a registered user to the lookup indexes"""
+        self.nicks.add(user.nickname, user)
+        self.hosts.add(user.hostname, user)
+        self.ips.add(user.ip, user)
+    
+    def unindex(self, user):
+        if user not in self.nicks.get(user.nickname):
+            return
+        self.nicks.remove(user.nickname, user)
+        self.hosts.remove(user.hostname, user)
+        self.ips.remove(user.ip, user)
+    
+    def lookup(self, mask, fields):
+        """Registered users matching a WHO mask on any of the given fields
+        
+        Fields are WHOX match flags: n(ick), u(ser), h(ost), i(p), s(erver)
+        and r(ealname). A nick!user@host mask is matched as a whole.
+        Candidates come from the nickname, hostname and IP indexes; masks
+        without a literal part and the username and realname fields need
+        every user checked.
+        """
+        if '!' in mask or '@' in mask:
+            mask = normalize_mask(mask)
+            regex = compile_mask(mask)
+            nick, rest = mask.split('!', 1)
+            host = rest.split('@', 1)[1]
+            candidates = self.nicks.search(nick)
+            if candidates is None:
+                candidates = self.candidates(host, "hi")
+            if candidates is None:
+                candidates = self.nicks.all()
+            users = [user for user in candidates if regex.match(user.fullname())]
+        else:
+            regex = compile_mask(mask)
+            candidates = self.candidates(mask, fields)
+            if candidates is None:
+                candidates = self.nicks.all()
+            users = [user for user in candidates
+                     if ('n' in fields and regex.match(user.nickname))
+                     or ('u' in fields and regex.match(user.username))
+                     or ('h' in fields and regex.match(user.hostname))
+                     or ('i' in fields and regex.match(user.ip))
+                     or ('s' in fields and regex.match(self.hostname))
+                     or ('r' in fields and regex.match(user.realname))]
+        users.sort(key=lambda user: user.nickname.lower())
+        return users
+    
+    def candidates(self, mask, fields):
+        """Users that may match mask on any of fields, None if all may"""
+        users = set()
+        for field in fields:
+            if field == 's':
+                if compile_mask(mask).match(self.hostname):
+                    return None
+                continue
+            if field not in "nhi":
+                return None
+            found = {'n': self.nicks, 'h': self.hosts, 'i': self.ips}[field].search(mask)
+            if found is None:
+                return None
+            users.update(found)
+        return users
+    
+    def cork(self):
+        self.corked = True
+    
+    def uncork(self, ready=()):
+        """Send to corked users and the ready ones select found writable"""
+        self.corked = False
+        users = self.corked_users
+        self.corked_users = []
+        self.send_backlogs(users + list(ready))
+    
+    def send_backlogs(self, users):
+        """Send to users with output waiting, fairly and within a budget
+        
+        Interactive traffic goes first: users just sent a PONG or a private
+        message, and users with no more than a quantum queued, get a
+        quantum each. Larger backlogs then take turns of a quantum, least
+        recently served first, until write_budget bytes or write_time
+        seconds are spent. The rest waits for the next loop iteration.
+        """
+        quantum = config.write_quantum
+        budget = config.write_budget
+        deadline = time.time() + config.write_time
+        
+        bulk = []
+        for user in set(users):
+            if not user.sendbuffer:
+                continue
+            if user.urgent or (len(user.sendbuffer) <= quantum and not user.pending):
+                user.urgent = False
+                budget -= user.flush(quantum)
+            if user.sendbuffer:
+                bulk.append(user)
+        
+        bulk.sort(key=lambda user: user.turn)
+        while bulk:
+            waiting = []
+            for user in bulk:
+                if budget <= 0 or time.time() > deadline:
+                    return
+                self.turns += 1
+                user.turn = self.turns
+                sent = user.flush(quantum)
+                budget -= sent
+                # Users whose socket filled up wait for select
+                if sent == quantum and user.sendbuffer:
+                    waiting.append(user)
+            bulk = waiting
+    
+    def caps(self):
+        caps = ["batch", "message-tags", "server-time"]
+        if config.history_length:
+            caps.append("draft/chathistory")
+        return caps
+    
     def run(self):
         # Bind port and listen
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -820,7 +2417,14 @@ class Server(socket.socket):
             # Find users with pending send data
             sendable = [user for user in self.users if user.sendbuffer]
             
-            read, write, error = select([self] + self.users, sendable, self.users, 25.0)
+            # Throttled users are not read from until their input is resumed
+            readable = [user for user in self.users if not user.throttled]
+            
+            timeout = 25.0
+            if self.scheduled:
+                timeout = min(timeout, max(0.0, self.scheduled[0][0] - time.time()))
+            
+            read, write, error = select([self] + readable, sendable, self.users, timeout)
             
             for user in error:
                 user.quit("Error: Connection reset by peer")
@@ -830,57 +2434,139 @@ class Server(socket.socket):
                 # Accept connection and create new user object
                 User(self, self.accept())
             
-            # Read from each user
+            # Read from each user, holding back output until every
+            # user has been handled so each recipient gets a single send
+            self.cork()
             for user in [user for user in read if user != self]:
                 try:
                     recv = user.socket.recv(4096)
-                except socket.error, e:
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except socket.error:
                     user.quit("Read error: Connection reset by peer")
-                if recv == '':
+                    continue
+                if not recv:
                     user.quit("Remote host closed the connection")
+                    continue
                 user.recvbuffer += recv
+                self.capture.receive(user, recv)
                 
                 # Excess Flood
-                if len(user.recvbuffer) > 1024:
+                if len(user.recvbuffer) > config.recvq_limit:
                     user.quit("Excess Flood")
                     continue
                 
                 user.handle_recv()
             
-            # Send to each user
-            for user in write:
-                try:
-                    sent = user.socket.send(user.sendbuffer)
-                    user.sendbuffer = user.sendbuffer[sent:]
-                except socket.error, e:
-                    user.quit("Write error: Connection reset by peer")
+            # Resume throttled users whose budget has refilled
+            while self.scheduled and self.scheduled[0][0] <= time.time():
+                when, sequence, user = heapq.heappop(self.scheduled)
+                if user.throttled:
+                    user.handle_recv()
+            
+            # Send new output and remaining backlogs
+            self.uncork(write)
             
             # Garbage collection (Empty Channels)
             for channel in [channel for channel in self.channels if len(channel.users) == 0]:
                 self.channels.remove(channel)
+                # Keep saved state if the channel was only created to be refused
+                if not channel.restored:
+                    self.store.drop(channel)
+            
+            # Save channel state changes
+            self.store.flush()
+            self.capture.flush()
+            if time.time() - self.store.snapshot_time > config.snapshot_interval:
+                self.store.snapshot()
+            
+            # Expire timed bans
+            self.bans.expire()
             
             # Ping timeouts
-            for user in [user for user in self.users if time.time() - user.ping > 250.0]:
-                user.quit("Ping timeout: %d seconds" % int(time.time() - user.ping))
+            self.timeouts()
             
             # Send out pings
             for user in [user for user in self.users if time.time() - user.ping > 125.0]:
-                try:
-                    user.socket.send("PING :%s\r\n" % self.hostname)
-                except socket.error, e:
-                    user.quit("Write error: Connection reset by peer")
+                user._send("PING :%s" % self.hostname)
+    
+    def quit(self, quits):
+        """Disconnect a list of (user, reason) and send out their QUITs
+        
+        Each affected channel is walked once however many of its members
+        are leaving, and users leaving together are not sent each other's
+        QUIT, so a mass disconnect costs time in proportion to the QUITs
+        actually delivered.
+        """
+        if quits == []:
+            return
+        
+        leaving = set()
+        unique = []
+        for user, reason in quits:
+            if user not in leaving:
+                leaving.add(user)
+                unique.append((user, reason))
+                user.disconnect(reason)
+        quits = unique
+        
+        # Hold back output until membership is consistent again, a failed
+        # write would otherwise quit a member in the middle of the update
+        corked = self.corked
+        self.cork()
+        
+        # Members that are staying, for every channel someone is leaving
+        staying = {}
+        for user in leaving:
+            for channel in user.channels:
+                if channel not in staying:
+                    staying[channel] = [member for member in channel.users if member not in leaving]
+        
+        # Send quit to all users in channels user is in
+        for user, reason in quits:
+            users = set()
+            for channel in user.channels:
+                if user not in channel.hidden:
+                    users.update(staying[channel])
+            user.broadcast(users, "QUIT :%s" % reason)
+        
+        # Remove users from all channels
+        for channel in staying:
+            for user in channel.users:
+                if user in leaving:
+                    channel.usermodes.pop(user, None)
+                    channel.banned.pop(user, None)
+                    channel.hidden.discard(user)
+            channel.users = [user for user in channel.users if user not in leaving]
+        for user in leaving:
+            user.channels = []
+            self.unindex(user)
+            self.capture.disconnect(user)
+        
+        # Remove users from server users
+        self.users = [user for user in self.users if user not in leaving]
+        
+        # These User objects should now be garbage collected...
+        
+        if not corked:
+            self.uncork()
+    
+    def timeouts(self):
+        now = time.time()
+        self.quit([(user, "Ping timeout: %d seconds" % int(now - user.ping)) for user in self.users if now - user.ping > 250.0])
     
     def shutdown(self):
-        for user in self.users:
-            user.quit("Server shutdown")
+        self.quit([(user, "Server shutdown") for user in self.users])
+        self.store.snapshot(wait=True)
+        self.capture.flush()
         self.close()
 
 if __name__ == "__main__":
     server = Server()
     try:
         server.run()
-    #except Exception, e:
-    #    print e
+    #except Exception as e:
+    #    print(e)
     except KeyboardInterrupt:
         pass
     finally:
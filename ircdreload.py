@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 #       ircdreload.py
@@ -21,6 +21,7 @@
 #       MA 02110-1301, USA.
 
 import traceback
+import importlib
 
 import ircd
 
@@ -30,12 +31,12 @@ while True:
         server.run()
     except (KeyboardInterrupt, Exception):
         traceback.print_exc()
-        x = raw_input("[r/q] ")
+        x = input("[r/q] ")
         if x == 'q':
             break
         else:
-            reload(ircd)
-            reload(ircd.config)
+            importlib.reload(ircd)
+            importlib.reload(ircd.config)
             old = server
             server = ircd.Server()
             server.channels = old.channels
@@ -46,6 +47,9 @@ while True:
                 newuser.username = olduser.nickname
                 newuser.realname = olduser.realname
                 newuser.away = olduser.away
+                newuser.caps = olduser.caps
+                if olduser in old.nicks.get(olduser.nickname):
+                    server.index(newuser)
                 for channel in olduser.channels:
                     try:
                         channel.users.remove(olduser)
@@ -54,6 +58,10 @@ while True:
                     channel.users.append(newuser)
                     channel.usermodes[newuser] = channel.usermodes[olduser]
                     channel.usermodes.pop(olduser)
+                    channel.banned.pop(olduser, None)
+                    if olduser in channel.hidden:
+                        channel.hidden.discard(olduser)
+                        channel.hidden.add(newuser)
                     newuser.channels.append(channel)
                 #server.users.append(newuser)
             old.close()